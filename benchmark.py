@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -"- encoding: utf-8 -"-
+# the script is Python2/3 compatible
+
+"""Benchmark the slot error checker and overlap removal on the data shipped in this repository.
+Times each processing stage separately, reports instances/sec and peak memory, and can compare
+the results with a stored baseline to flag regressions."""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import codecs
+import glob
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pandas as pd
+
+import e2e_mr
+import slot_error
+from slot_error import (CAPITALIZE, check_output, format_mr, load_lines, reclassify_mr,
+                        timer, write_outputs)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ['load', 'parse', 'reclassify', 'check', 'serialise', 'write', 'overlaps']
+# cold start in a new process: importing slot_error, and scoring a one-line TXT file from the command line
+STARTUP_STAGES = ['import', 'one-line']
+
+
+def peak_rss():
+    """Return peak resident set size of the process in MB (None if not available)."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def known_mr(mr_text):
+    """Check that all values of the MR are known to the checker (the system outputs' MR file
+    has some `name[NO_REF_FOUND]` MRs which would make it crash)."""
+    return all(value.lower() in CAPITALIZE.get(slot, {}) for slot, value in e2e_mr.parse(mr_text))
+
+
+def list_corpora():
+    """Return the corpora to benchmark: name -> list of (input file, MR file or None)."""
+    corpora = OrderedDict()
+    corpora['cleaned'] = [(fname, None) for fname in sorted(glob.glob(os.path.join(BASE_DIR, 'cleaned-data', '*.csv')))]
+    corpora['partial'] = [(fname, None) for fname in
+                          sorted(glob.glob(os.path.join(BASE_DIR, 'partially-cleaned-data', '*', '*.csv')))]
+    mr_file = os.path.join(BASE_DIR, 'system-outputs', 'sclstm_MRs-for-eval.txt')
+    corpora['system-outputs'] = [(fname, mr_file) for fname in
+                                 sorted(glob.glob(os.path.join(BASE_DIR, 'system-outputs', '*', '*.txt')))]
+    return corpora
+
+
+class StageTimer(object):
+    """Accumulates time spent in the individual processing stages."""
+
+    def __init__(self):
+        self.times = OrderedDict((stage, 0.0) for stage in STAGES)
+
+    @contextmanager
+    def __call__(self, stage):
+        start = timer()
+        yield
+        self.times[stage] += timer() - start
+
+
+def load_file(filename, mr_file, mr_lines_cache):
+    """Load raw MR strings and refs (+ data frame for CSV inputs) from a file. System output TXT
+    files are paired with the MRs line by line, leaving out instances with unknown values. Returns
+    None if the number of lines differs from the MR file."""
+    if mr_file is None:
+        df = pd.read_csv(filename, encoding='UTF-8')
+        return df, 'mr', 'ref', list(df['mr']), list(df['ref'])
+    if mr_file not in mr_lines_cache:
+        mr_lines = load_lines(mr_file)
+        mr_lines_cache[mr_file] = list(zip(mr_lines, [known_mr(mr) for mr in mr_lines]))
+    refs = load_lines(filename)
+    if len(refs) != len(mr_lines_cache[mr_file]):
+        print("%s: %d lines but %d MRs in %s, skipping" % (os.path.relpath(filename, BASE_DIR), len(refs),
+                                                          len(mr_lines_cache[mr_file]), os.path.relpath(mr_file, BASE_DIR)),
+              file=sys.stderr)
+        return None
+    pairs = [(mr, ref) for (mr, known), ref in zip(mr_lines_cache[mr_file], refs) if known]
+    raw_mrs, refs = [list(col) for col in zip(*pairs)]
+    return None, 'mr', 'ref', raw_mrs, refs
+
+
+def reset_state():
+    """Clear all memos and compiled patterns, so that repeated runs do not just measure memo hits.
+    The matcher is then created beforehand, so it does not count towards the first stage."""
+    e2e_mr._PARSE_MEMO.clear()
+    slot_error._GOLD_DICTS.clear()
+    slot_error._MATCHER = None
+    re.purge()
+    reclassify_mr('warm up', e2e_mr.parse('name[Blue Spice]'))
+
+
+def bench_corpus(files, out_dir):
+    """Run all stages over the given files, return the number of instances, stage times and the files
+    skipped because their number of lines differs from their MR file."""
+    from remove_overlaps import MRIndex
+    stage = StageTimer()
+    insts = 0
+    skipped = []
+    mr_lines_cache = {}
+    index = MRIndex()
+    for file_no, (filename, mr_file) in enumerate(files):
+        with stage('load'):
+            loaded = load_file(filename, mr_file, mr_lines_cache)
+        if loaded is None:
+            skipped.append(filename)
+            continue
+        df, mr_col, ref_col, raw_mrs, refs = loaded
+        with stage('parse'):
+            mrs = [e2e_mr.parse(mr) for mr in raw_mrs]
+        with stage('reclassify'):
+            classified = [reclassify_mr(ref, mr) for mr, ref in zip(mrs, refs)]
+        with stage('check'):
+            checked = [check_output(gold_mr, out_mr, 'all') for out_mr, gold_mr in classified]
+        with stage('serialise'):
+            fixed_mrs = [format_mr(out_mr) for _, _, _, _, _, out_mr in checked]
+        results = [(inst_a, inst_m, inst_v, inst_r, len(mr), diff, fixed_mr)
+                   for mr, (inst_a, inst_m, inst_v, inst_r, diff, _), fixed_mr in zip(mrs, checked, fixed_mrs)]
+        with stage('write'):
+            write_outputs(df, mr_col, ref_col, raw_mrs, refs, results,
+                          dump=os.path.join(out_dir, '%d.dump.tsv' % file_no),
+                          fix=os.path.join(out_dir, '%d.fix.csv' % file_no))
+        if df is not None and 'orig_mr' in df.columns:
+            with stage('overlaps'):
+                keys = index.map(pd.Series(raw_mrs))
+                keys.isin(set(index.map(df['orig_mr'])))
+        insts += len(refs)
+    return insts, stage.times, skipped
+
+
+def bench_startup(out_dir):
+    """Time the startup stages, each in a new Python process (with bytecode already cached). The time
+    a bare interpreter takes to start is subtracted."""
+    mr_file = os.path.join(out_dir, 'startup.mrs.txt')
+    ref_file = os.path.join(out_dir, 'startup.txt')
+    with codecs.open(mr_file, 'w', 'UTF-8') as fh:
+        print('inform(name=Zizzi,food=Italian,area=riverside)', file=fh)
+    with codecs.open(ref_file, 'w', 'UTF-8') as fh:
+        print('Zizzi serves Italian food by the river.', file=fh)
+    commands = OrderedDict([('python', [sys.executable, '-c', 'pass']),
+                            ('import', [sys.executable, '-c', 'import slot_error']),
+                            ('one-line', [sys.executable, os.path.join(BASE_DIR, 'slot_error.py'),
+                                          '-m', mr_file, ref_file])])
+    times = OrderedDict()
+    with open(os.devnull, 'w') as devnull:
+        for stage, command in commands.items():
+            start = timer()
+            subprocess.check_call(command, cwd=BASE_DIR, stdout=devnull)
+            times[stage] = timer() - start
+    python = times.pop('python')
+    return OrderedDict((stage, max(secs - python, 0.0)) for stage, secs in times.items())
+
+
+def run_benchmark(corpora, repeat=1):
+    """Benchmark the given corpora, return the results as a dict. With `repeat` > 1, the best time
+    for each stage is used (each run starts with memos cleared)."""
+    results = OrderedDict()
+    out_dir = tempfile.mkdtemp(prefix='slot_error_bench.')
+    try:
+        bench_startup(out_dir)  # make sure bytecode is cached
+        startup = None
+        for _ in range(repeat):
+            times = bench_startup(out_dir)
+            startup = times if startup is None else OrderedDict((s, min(startup[s], times[s])) for s in STARTUP_STAGES)
+        for name, files in corpora.items():
+            best = None
+            for _ in range(repeat):
+                reset_state()
+                insts, times, skipped = bench_corpus(files, out_dir)
+                best = times if best is None else OrderedDict((s, min(best[s], times[s])) for s in STAGES)
+            total = sum(best.values())
+            results[name] = OrderedDict([('files', len(files) - len(skipped)),
+                                         ('skipped', [os.path.relpath(fname, BASE_DIR) for fname in skipped]),
+                                         ('instances', insts),
+                                         ('stages', best),
+                                         ('total', total),
+                                         ('insts_per_sec', insts / total if total else 0.0)])
+    finally:
+        shutil.rmtree(out_dir)
+    return OrderedDict([('startup', startup),
+                        ('corpora', results),
+                        ('peak_rss_mb', peak_rss()),
+                        ('python', sys.version.split()[0]),
+                        ('patterns', slot_error.PATTERNS_HASH)])
+
+
+def print_results(results, out=sys.stdout):
+    print("startup: " + ", ".join("%s: %.3f" % (stage, secs) for stage, secs in results['startup'].items()), file=out)
+    for name, res in results['corpora'].items():
+        print("%s: %d files, %d instances, %.3f s, %.1f insts/sec" %
+              (name, res['files'], res['instances'], res['total'], res['insts_per_sec']), file=out)
+        print("  " + ", ".join("%s: %.3f" % (stage, secs) for stage, secs in res['stages'].items()), file=out)
+        if res.get('skipped'):
+            print("  %d files skipped (line count differs from the MRs)" % len(res['skipped']), file=out)
+    if results['peak_rss_mb'] is not None:
+        print("Peak RSS: %.1f MB" % results['peak_rss_mb'], file=out)
+
+
+def compare(results, baseline, tolerance, out=sys.stdout):
+    """Compare results with a baseline, print the differences and return a list of regressions
+    (stages or totals that got slower by more than the `tolerance` ratio)."""
+    regressions = []
+    if baseline.get('startup'):
+        for stage, secs in results['startup'].items():
+            base_secs = baseline['startup'].get(stage, 0.0)
+            ratio = secs / base_secs if base_secs else 1.0
+            flag = ''
+            if ratio > 1.0 + tolerance and secs - base_secs > 0.01:
+                flag = '  REGRESSION'
+                regressions.append('startup/%s' % stage)
+            print("startup %-10s %8.3f s vs. %8.3f s (x%.2f)%s" % (stage, secs, base_secs, ratio, flag), file=out)
+    for name, res in results['corpora'].items():
+        if name not in baseline['corpora']:
+            continue
+        base = baseline['corpora'][name]
+        if base['instances'] != res['instances']:
+            print("%s: instance count differs from baseline (%d vs. %d), not comparing" %
+                  (name, res['instances'], base['instances']), file=out)
+            continue
+        items = [(stage, res['stages'][stage], base['stages'].get(stage, 0.0)) for stage in STAGES]
+        items.append(('total', res['total'], base['total']))
+        for stage, secs, base_secs in items:
+            ratio = secs / base_secs if base_secs else 1.0
+            flag = ''
+            # ignore tiny absolute differences, which are just noise
+            if ratio > 1.0 + tolerance and secs - base_secs > 0.01:
+                flag = '  REGRESSION'
+                regressions.append('%s/%s' % (name, stage))
+            print("%s %-10s %8.3f s vs. %8.3f s (x%.2f)%s" % (name, stage, secs, base_secs, ratio, flag), file=out)
+    if results['peak_rss_mb'] is not None and baseline.get('peak_rss_mb'):
+        ratio = results['peak_rss_mb'] / baseline['peak_rss_mb']
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append('peak_rss')
+        print("Peak RSS %.1f MB vs. %.1f MB (x%.2f)%s" %
+              (results['peak_rss_mb'], baseline['peak_rss_mb'], ratio, flag), file=out)
+    return regressions
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    corpora = list_corpora()
+    ap = ArgumentParser(description='Benchmark slot error checking and overlap removal on the data in this repository')
+    ap.add_argument('--corpus', '-c', action='append', choices=list(corpora.keys()),
+                    help='Corpora to benchmark (repeat for more, defaults to all)')
+    ap.add_argument('--repeat', '-r', type=int, default=1, help='Repeat each run, use the best times')
+    ap.add_argument('--output', '-o', type=str, help='Save results to a JSON file (can be used as a baseline)')
+    ap.add_argument('--baseline', '-b', type=str, help='Compare with a baseline JSON file, exit with 1 on regressions')
+    ap.add_argument('--tolerance', type=float, default=0.1,
+                    help='Slowdown ratio tolerated before flagging a regression (default: 0.1 = 10%%)')
+    args = ap.parse_args()
+
+    if args.corpus:
+        corpora = OrderedDict((name, files) for name, files in corpora.items() if name in args.corpus)
+    results = run_benchmark(corpora, args.repeat)
+    print_results(results)
+
+    if args.output:
+        with codecs.open(args.output, 'w', 'UTF-8') as fh:
+            json.dump(results, fh, indent=2)
+    if args.baseline:
+        with codecs.open(args.baseline, 'r', 'UTF-8') as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions: %s" % ", ".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -"- encoding: utf-8 -"-
+# the script is Python2/3 compatible
+
+"""Parsing and serialization of E2E MRs, without the need for TGen.
+
+MRs are represented as tuples of (slot, value) pairs, in the order given. Slot names are
+normalized to the TGen style (`eat_type`, `price_range`, `rating` etc.), values are kept as they
+are. All strings are interned and parsed MRs are memoized, since the same MRs repeat a lot in
+the data.
+
+Accepts MRs both in the E2E data format (`name[The Eagle], eatType[pub], customer rating[high]`)
+and in the TGen format (`inform(name=The Eagle,eat_type=pub)&inform(rating=high)`).
+"""
+
+from __future__ import unicode_literals
+
+import re
+import sys
+
+try:
+    intern
+except NameError:  # Python 3
+    intern = sys.intern
+
+
+# slots in the order of the E2E NLG data and their names in the E2E format
+SLOTS = ['name', 'eat_type', 'food', 'price_range', 'rating', 'area', 'family_friendly', 'near']
+SLOT_ORDER = {slot: pos for pos, slot in enumerate(SLOTS)}
+E2E_SLOT_NAMES = {'name': 'name', 'eat_type': 'eatType', 'food': 'food', 'price_range': 'priceRange',
+                  'rating': 'customer rating', 'area': 'area', 'family_friendly': 'familyFriendly', 'near': 'near'}
+# slot names as found in the E2E format -> TGen style
+SLOT_NAMES = {e2e_name: slot for slot, e2e_name in E2E_SLOT_NAMES.items()}
+
+MEMO_SIZE = 100000
+_PARSE_MEMO = {}
+
+_E2E_DAI = re.compile(r'\s*([^\[\],]+?)\s*\[([^\]]*)\]\s*(?:,|$)')
+_TGEN_DAI = re.compile(r'\s*(\w+)\(([^)]*)\)\s*(?:&|$)')
+
+
+def norm_slot(slot):
+    """Normalize a slot name to the TGen style (camelCase to snake_case, customer rating -> rating)."""
+    if slot in SLOT_NAMES:
+        return SLOT_NAMES[slot]
+    slot = re.sub(r'([A-Z])', lambda match: '_' + match.group(1).lower(), slot)
+    return 'rating' if slot == 'customer rating' else slot
+
+
+def _parse_e2e(text):
+    return tuple((intern(norm_slot(slot)), intern(value)) for slot, value in _E2E_DAI.findall(text))
+
+
+def _parse_tgen(text):
+    mr = []
+    for _, svps in _TGEN_DAI.findall(text):
+        for svp in svps.split(','):
+            if not svp:
+                continue
+            slot, _, value = svp.partition('=')
+            if value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            mr.append((intern(norm_slot(slot.strip())), intern(value)))
+    return tuple(mr)
+
+
+def parse(text):
+    """Parse an MR string (E2E or TGen format) into a tuple of (slot, value) pairs."""
+    mr = _PARSE_MEMO.get(text)
+    if mr is None:
+        mr = _parse_tgen(text) if re.match(r'\s*\w+\(', text) else _parse_e2e(text)
+        if len(_PARSE_MEMO) >= MEMO_SIZE:
+            _PARSE_MEMO.clear()
+        _PARSE_MEMO[text] = mr
+    return mr
+
+
+def from_da(mr):
+    """Convert a TGen DA (any object with `dais` that have `slot` and `value`) into a tuple of
+    (slot, value) pairs, as returned by `parse`. Other MRs are returned unchanged."""
+    if hasattr(mr, 'dais'):
+        return tuple((dai.slot, dai.value) for dai in mr.dais)
+    return mr
+
+
+def to_string(mr):
+    """Serialize a parsed MR (or a TGen DA) with TGen-style slot names (`eat_type[pub], rating[high]`),
+    the same as TGen's `DA.to_diligent_da_string`."""
+    return ', '.join('%s[%s]' % (slot, value) for slot, value in from_da(mr))
+
+
+def delexicalize(mr, slots):
+    """Replace values of the given slots with `X-slot` placeholders."""
+    return tuple((slot, 'X-' + slot if slot in slots else value) for slot, value in mr)
+
+
+def format_dict(mr_dict):
+    """Serialize a dict-based MR (slot -> values) in the E2E data format, with slots in the order
+    of the E2E data (values of the same slot in the order given)."""
+    pairs = sorted(((slot, value) for slot, values in mr_dict.items() for value in values),
+                   key=lambda pair: SLOT_ORDER[pair[0]])
+    return ', '.join('%s[%s]' % (E2E_SLOT_NAMES[slot], value) for slot, value in pairs)
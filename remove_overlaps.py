@@ -1,85 +1,205 @@
 #!/usr/bin/env python3
 
+import codecs
+import json
+import os
 import re
+import zlib
 from argparse import ArgumentParser
 
+import numpy as np
 import pandas as pd
 
-from tgen.data import DA
+import e2e_mr
 
 
 def parse_mr(mr_text):
-    return DA.parse_diligent_da(mr_text).get_delexicalized(set(['name', 'near']))
+    return e2e_mr.delexicalize(e2e_mr.parse(mr_text), set(['name', 'near']))
+
+
+class MRIndex(object):
+    """Memo of MR string -> canonical delexicalized MR key (the delexicalized MR
+    serialized by `e2e_mr.to_string`), optionally persisted as JSON so that MRs already seen
+    in previous runs are not parsed again."""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.keys = {}
+        self.new = 0
+        if filename and os.path.isfile(filename):
+            with codecs.open(filename, 'r', 'UTF-8') as fh:
+                self.keys = json.load(fh)
+
+    def map(self, mrs):
+        """Return a Series of keys for a Series of MR strings; each distinct MR string
+        is parsed at most once."""
+        for mr in mrs.unique():
+            if mr not in self.keys:
+                self.keys[mr] = e2e_mr.to_string(parse_mr(mr))
+                self.new += 1
+        return mrs.map(self.keys)
+
+    def save(self):
+        if not self.filename or not self.new:
+            return
+        with codecs.open(self.filename, 'w', 'UTF-8') as fh:
+            json.dump(self.keys, fh, ensure_ascii=False, sort_keys=True)
+
+
+def normalize_ref(text):
+    """Lowercase the text and replace punctuation with spaces, return a list of words."""
+    return re.sub(r'[\W_]+', ' ', str(text).lower()).split()
+
+
+class NearDupIndex(object):
+    """MinHash/LSH index of word shingles of reference texts, to find near-duplicate refs (with Jaccard
+    similarity of their shingle sets at least `threshold`) without comparing all pairs. Refs sharing an LSH
+    bucket with a query are only candidates, their similarity is then checked exactly."""
+
+    PRIME = (1 << 31) - 1
+
+    def __init__(self, threshold=0.8, shingle_size=3, num_perm=128, seed=42):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands, self.rows = self.lsh_params(threshold, num_perm)
+        rng = np.random.RandomState(seed)
+        self.perm_a = rng.randint(1, self.PRIME, size=self.bands * self.rows).astype(np.int64)
+        self.perm_b = rng.randint(0, self.PRIME, size=self.bands * self.rows).astype(np.int64)
+        self.buckets = [{} for _ in range(self.bands)]  # band -> signature slice -> ref IDs
+        self.shingle_sets = []
+
+    @staticmethod
+    def lsh_params(threshold, num_perm):
+        """Split `num_perm` hash functions into bands of rows so that the LSH threshold (the similarity at which
+        refs become likely candidates, about (1/bands) ** (1/rows)) is as close as possible below the
+        similarity threshold -- i.e. favor recall, candidates are checked anyway."""
+        options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+        below = [(bands, rows) for bands, rows in options if (1.0 / bands) ** (1.0 / rows) <= threshold]
+        return max(below or options[:1], key=lambda band_rows: (1.0 / band_rows[0]) ** (1.0 / band_rows[1]))
+
+    def shingles(self, text):
+        """Return the set of word n-grams of the normalized text, as 31-bit hashes."""
+        words = normalize_ref(text)
+        size = min(self.shingle_size, len(words)) or 1
+        return set(zlib.crc32(' '.join(words[pos:pos + size]).encode('utf-8')) & self.PRIME
+                   for pos in range(max(len(words) - size + 1, 1)))
+
+    def signatures(self, shingle_sets):
+        """Compute MinHash signatures for a list of shingle sets (a matrix with a row for each set)."""
+        sigs = np.empty((len(shingle_sets), len(self.perm_a)), dtype=np.int64)
+        step = 2000
+        for start in range(0, len(shingle_sets), step):
+            block = shingle_sets[start:start + step]
+            lens = [len(shingles) for shingles in block]
+            hashes = np.fromiter((sh for shingles in block for sh in shingles), dtype=np.int64, count=sum(lens))
+            perms = (hashes[:, np.newaxis] * self.perm_a + self.perm_b) % self.PRIME
+            sigs[start:start + len(block)] = np.minimum.reduceat(perms, np.cumsum([0] + lens[:-1]), axis=0)
+        return sigs
+
+    def _keys(self, sig):
+        return [sig[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, refs):
+        """Add refs to the index."""
+        shingle_sets = [self.shingles(ref) for ref in refs]
+        for ref_id, sig in enumerate(self.signatures(shingle_sets), start=len(self.shingle_sets)):
+            for band, key in enumerate(self._keys(sig)):
+                self.buckets[band].setdefault(key, []).append(ref_id)
+        self.shingle_sets.extend(shingle_sets)  # kept for exact similarity checks
+
+    def query(self, refs):
+        """Return a boolean array telling which of the refs have a near-duplicate in the index."""
+        shingle_sets = [self.shingles(ref) for ref in refs]
+        found = np.zeros(len(refs), dtype=bool)
+        for pos, (shingles, sig) in enumerate(zip(shingle_sets, self.signatures(shingle_sets))):
+            cands = set()
+            for band, key in enumerate(self._keys(sig)):
+                cands.update(self.buckets[band].get(key, ()))
+            for cand in cands:
+                other = self.shingle_sets[cand]
+                if len(shingles & other) >= self.threshold * len(shingles | other):
+                    found[pos] = True
+                    break
+        return found
+
+
+def load_split(filename, index):
+    data = pd.read_csv(filename, encoding="UTF-8")
+    data['mr'] = data['mr'].fillna('')
+    return data, index.map(data['mr']), set(index.map(data['orig_mr']))
+
 
 def main(args):
 
-    train = pd.read_csv(args.input_train, encoding="UTF-8")
-    train['mr'] = train['mr'].fillna('')
-    devel = pd.read_csv(args.input_devel, encoding="UTF-8")
-    devel['mr'] = devel['mr'].fillna('')
-    test = pd.read_csv(args.input_test, encoding="UTF-8")
-    test['mr'] = test['mr'].fillna('')
-
-    test_orig_mrs = set([parse_mr(mr) for mr in list(test['orig_mr'])])
-    test_mrs = set([parse_mr(mr) for mr in list(test['mr'])])
-    print("Test set distinct MR count: %d, originally %d" % (len(test_mrs), len(test_orig_mrs)))
-
-    print("Checking devel set...")
-
-    # check devel data:
-    devel_idx_to_del = []
-    devel_orig_mrs = set([parse_mr(mr) for mr in list(devel['orig_mr'])])
-    devel_mrs = set()
-    avoid = test_mrs | test_orig_mrs
-    for idx, inst in devel.iterrows():
-        mr = parse_mr(inst.mr)
-        devel_mrs.add(mr)
-        if mr in avoid:
-            devel_idx_to_del.append(idx)
-
-    print("To delete: %d / %d instances from devel, %d / %d distinct MRs" %
-          (len(devel_idx_to_del), len(devel), len(devel_mrs & avoid), len(devel_mrs)))
-    devel = devel.drop(devel_idx_to_del)
-
-    output_devel = re.sub('(\.[^.]+)$', args.suffix + r'\1', args.input_devel)
-    print("Writing fixed %s..." % output_devel)
-    devel.to_csv(output_devel, encoding='UTF-8', index=False)
-    print("%d instances, %d distinct (delexicalized) MRs." % (len(devel), len(devel_mrs - avoid)))
-    print("Original distinct MR count: %d" % len(devel_orig_mrs))
-
-
-    print("Checking train set...")
-
-    # check train data
-    train_idx_to_del = []
-    train_orig_mrs = set([parse_mr(mr) for mr in list(train['orig_mr'])])
-    train_mrs = set()
-    avoid = devel_mrs | test_mrs | test_orig_mrs
-    for idx, inst in train.iterrows():
-        mr = parse_mr(inst.mr)
-        train_mrs.add(mr)
-        if mr in avoid:
-            train_idx_to_del.append(idx)
-
-    print("To delete: %d / %d instances from devel, %d / %d distinct MRs" %
-          (len(train_idx_to_del), len(train), len(train_mrs & avoid), len(train_mrs)))
-    train = train.drop(train_idx_to_del)
-
-    output_train = re.sub('(\.[^.]+)$', args.suffix + r'\1', args.input_train)
-    print("Writing fixed %s..." % output_train)
-    train.to_csv(output_train, encoding='UTF-8', index=False)
-    print("%d instances, %d distinct (delexicalized) MRs." % (len(train), len(train_mrs - avoid)))
-    print("Original distinct MR count: %d" % len(train_orig_mrs))
+    index = MRIndex(args.index)
+
+    # splits go from the lowest to the highest priority, the last one is kept intact
+    *inputs, input_protected = args.input_files
+
+    protected, protected_keys, protected_orig_keys = load_split(input_protected, index)
+    protected_mrs = set(protected_keys)
+    print("Test set distinct MR count: %d, originally %d" % (len(protected_mrs), len(protected_orig_keys)))
+
+    # near-duplicate refs are looked up in all higher-priority splits, too
+    near_dups = None
+    if args.near_dups:
+        near_dups = NearDupIndex(args.similarity, args.shingle_size, args.num_perm)
+        near_dups.add(list(protected['ref']))
+
+    avoid = protected_mrs | protected_orig_keys
+    for input_file in reversed(inputs):
+
+        print("Checking %s..." % input_file)
 
+        data, keys, orig_mrs = load_split(input_file, index)
+        mrs = set(keys)
+        to_del = keys.isin(avoid)
+
+        print("To delete: %d / %d instances from %s, %d / %d distinct MRs" %
+              (to_del.sum(), len(data), input_file, len(mrs & avoid), len(mrs)))
+        if near_dups is not None:
+            is_dup = pd.Series(False, index=data.index)
+            is_dup[~to_del] = near_dups.query(list(data['ref'][~to_del]))
+            print("Near-duplicate refs: %d / %d remaining instances from %s" %
+                  (is_dup.sum(), (~to_del).sum(), input_file))
+            near_dups.add(list(data['ref']))
+            if args.near_dups == 'drop':
+                to_del |= is_dup
+                print("To delete in total: %d / %d instances from %s" % (to_del.sum(), len(data), input_file))
+            else:
+                data['near_dup'] = is_dup.astype(int)
+        data = data[~to_del]
+
+        output_file = re.sub(r'(\.[^.]+)$', args.suffix + r'\1', input_file)
+        print("Writing fixed %s..." % output_file)
+        data.to_csv(output_file, encoding='UTF-8', index=False)
+        print("%d instances, %d distinct (delexicalized) MRs." % (len(data), len(mrs - avoid)))
+        print("Original distinct MR count: %d" % len(orig_mrs))
+
+        # lower-priority splits must avoid all MRs of this one, even those just deleted
+        avoid = avoid | mrs
+
+    index.save()
 
 
 if __name__ == '__main__':
     ap = ArgumentParser(description='Remove overlapping MRs from different parts of the dataset (aiming to keep the test set intact)')
     ap.add_argument('--suffix', '-s', type=str, default='.no-ol', help='Suffix to add to output filenames')
-    ap.add_argument('input_train', type=str, help='Input training set CSV')
-    ap.add_argument('input_devel', type=str, help='Input development set CSV')
-    ap.add_argument('input_test', type=str, help='Input test set CSV')
+    ap.add_argument('--index', '-i', type=str, help='JSON file with MR -> delexicalized MR index, ' +
+                    'reused across runs (created if it does not exist)')
+    ap.add_argument('--near-dups', '-n', choices=['flag', 'drop'],
+                    help='Also find instances whose refs are near-duplicates of refs in later files, and flag ' +
+                    'them (in a near_dup column) or drop them')
+    ap.add_argument('--similarity', type=float, default=0.8,
+                    help='Min. Jaccard similarity of word shingles for near-duplicate refs (default: 0.8)')
+    ap.add_argument('--shingle-size', type=int, default=3, help='Number of words in a shingle (default: 3)')
+    ap.add_argument('--num-perm', type=int, default=128,
+                    help='Number of MinHash functions for finding near-duplicate candidates (default: 128)')
+    ap.add_argument('input_files', type=str, nargs='+',
+                    help='Input CSVs ordered by increasing priority, e.g. train, devel, test; ' +
+                    'an instance whose MR overlaps a later file is removed, the last file is kept intact')
     args = ap.parse_args()
+    if len(args.input_files) < 2:
+        ap.error('At least two input files are needed')
 
     main(args)
-
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -"- encoding: utf-8 -"-
+# the script is Python2/3 compatible
+
+"""Bootstrap confidence intervals and significance tests for the slot error statistics.
+
+All statistics reported by `slot_error.py` are ratios of sums of per-instance values (SemERR = errors / MR
+length, Inst* = instances of the given class / all instances), so they are computed from per-instance
+vectors kept as NumPy arrays. Resampling is done for many resamples at once: each batch of resamples is
+a matrix of instance counts, multiplied by the per-instance values.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+METRICS = ['semerr', 'inst_ok', 'inst_add', 'inst_mis', 'inst_m+a']
+
+# max. number of matrix cells per batch of resamples
+BATCH_CELLS = 1 << 22
+
+
+class ErrorVectors(object):
+    """Per-instance error counts and MR lengths of checked inputs, keyed by label. Also keeps a hash of
+    the MRs, so that it can be checked whether two inputs can be compared instance by instance."""
+
+    def __init__(self):
+        self.chunks = OrderedDict()  # label -> list of (errors, MR lengths, instance classes) arrays
+        self.mr_hashes = OrderedDict()
+
+    def add(self, label, raw_mrs, results):
+        """Add `score_instances` results for the given raw MR strings."""
+        counts = np.array([result[:5] for result in results], dtype=np.int64).reshape(-1, 5)
+        added, missing, valerr, repeated, mr_len = counts.T
+        # instance classes, the same as in `Stats.add` (ok, added, missing, missing+added)
+        classes = np.select([((added > 0) & (missing > 0)) | (valerr > 0), (added > 0) | (repeated > 0), missing > 0],
+                            [3, 1, 2], 0)
+        self.chunks.setdefault(label, []).append((added + missing + valerr + repeated, mr_len, classes))
+        mr_hash = self.mr_hashes.setdefault(label, hashlib.sha1())
+        for mr in raw_mrs:
+            mr_hash.update(mr.encode('utf-8') + b'\n')
+
+    def labels(self):
+        return list(self.chunks.keys())
+
+    def values(self, label):
+        """Return per-instance values for all metrics (a matrix with a row for each of METRICS) and their
+        denominators (MR lengths for SemERR, ones for the Inst* rates)."""
+        errors, mr_len, classes = [np.concatenate(arrays) for arrays in zip(*self.chunks[label])]
+        values = np.vstack([errors] + [classes == cls for cls in range(4)]).astype(np.float64)
+        denoms = np.vstack([mr_len] + [np.ones(len(classes))] * 4).astype(np.float64)
+        return values, denoms
+
+    def paired(self, label, other):
+        """Check if the inputs were checked against the same MRs, in the same order."""
+        return self.mr_hashes[label].digest() == self.mr_hashes[other].digest()
+
+
+def _resample_counts(rng, n_insts, n_resamples):
+    """Yield matrices of instance counts for batches of bootstrap resamples (each row sums up to `n_insts`)."""
+    batch = max(1, min(n_resamples, BATCH_CELLS // max(n_insts, 1)))
+    for start in range(0, n_resamples, batch):
+        rows = min(batch, n_resamples - start)
+        idxs = rng.randint(0, n_insts, size=(rows, n_insts)) + (np.arange(rows) * n_insts)[:, np.newaxis]
+        yield np.bincount(idxs.ravel(), minlength=rows * n_insts).reshape(rows, n_insts).astype(np.float64)
+
+
+def _bootstrap(rng, values, denoms, n_resamples):
+    """Return resampled metric values (a matrix with a row for each resample and a column for each metric)."""
+    samples = []
+    for counts in _resample_counts(rng, values.shape[1], n_resamples):
+        samples.append(counts.dot(values.T) / counts.dot(denoms.T))
+    return np.vstack(samples)
+
+
+def metrics(values, denoms):
+    """Compute the metrics from per-instance values."""
+    return values.sum(axis=1) / denoms.sum(axis=1)
+
+
+def bootstrap_ci(values, denoms, n_resamples=1000, confidence=0.95, seed=None):
+    """Compute percentile bootstrap confidence intervals for all metrics. Returns a dict
+    metric -> (value, lower bound, upper bound)."""
+    rng = np.random.RandomState(seed)
+    samples = _bootstrap(rng, values, denoms, n_resamples)
+    alpha = (1.0 - confidence) / 2.0
+    lower, upper = np.percentile(samples, [100 * alpha, 100 * (1.0 - alpha)], axis=0)
+    return OrderedDict((metric, (float(value), float(lo), float(hi)))
+                       for metric, value, lo, hi in zip(METRICS, metrics(values, denoms), lower, upper))
+
+
+def paired_bootstrap(values_a, values_b, denoms, n_resamples=1000, confidence=0.95, seed=None):
+    """Paired bootstrap test of the differences between two systems (A - B) checked against the same MRs
+    (the denominators are the same). Returns a dict metric -> (difference, CI lower bound, CI upper bound,
+    two-sided p-value), where the p-value is twice the share of resamples where the difference
+    has the opposite sign or is zero."""
+    rng = np.random.RandomState(seed)
+    samples = _bootstrap(rng, values_a - values_b, denoms, n_resamples)
+    diffs = metrics(values_a, denoms) - metrics(values_b, denoms)
+    alpha = (1.0 - confidence) / 2.0
+    lower, upper = np.percentile(samples, [100 * alpha, 100 * (1.0 - alpha)], axis=0)
+    opposite = np.where(diffs > 0, (samples <= 0).mean(axis=0), (samples >= 0).mean(axis=0))
+    return OrderedDict((metric, (float(diff), float(lo), float(hi), min(1.0, 2 * float(p_value))))
+                       for metric, diff, lo, hi, p_value in zip(METRICS, diffs, lower, upper, opposite))
+
+
+def approximate_randomization(values_a, values_b, denoms, n_trials=1000, seed=None):
+    """Approximate randomization test of the differences between two systems checked against the same MRs:
+    the systems' results are swapped for random subsets of instances. Returns a dict metric -> two-sided p-value."""
+    rng = np.random.RandomState(seed)
+    n_insts = values_a.shape[1]
+    diffs = values_a - values_b
+    totals = denoms.sum(axis=1)
+    observed = np.abs(diffs.sum(axis=1) / totals)
+    hits = np.zeros(len(METRICS))
+    batch = max(1, min(n_trials, BATCH_CELLS // max(n_insts, 1)))
+    for start in range(0, n_trials, batch):
+        signs = rng.randint(0, 2, size=(min(batch, n_trials - start), n_insts)) * 2.0 - 1.0
+        trial_diffs = np.abs(signs.dot(diffs.T) / totals)
+        # count differences at least as large as the observed ones (up to rounding errors)
+        hits += (trial_diffs >= observed - 1e-12).sum(axis=0)
+    return OrderedDict((metric, float(hit + 1.0) / (n_trials + 1.0)) for metric, hit in zip(METRICS, hits))
+
+
+def ci_table(vectors, n_resamples=1000, confidence=0.95, seed=None):
+    """Bootstrap confidence intervals for all inputs in `ErrorVectors`, as a pandas DataFrame."""
+    import pandas as pd
+    rows = []
+    for label in vectors.labels():
+        values, denoms = vectors.values(label)
+        row = OrderedDict([('filename', label), ('total_insts', values.shape[1])])
+        for metric, (value, lo, hi) in bootstrap_ci(values, denoms, n_resamples, confidence, seed).items():
+            row[metric] = value
+            row[metric + '_lo'] = lo
+            row[metric + '_hi'] = hi
+        rows.append(row)
+    return pd.DataFrame(rows, columns=list(rows[0].keys()) if rows else None)
+
+
+def pairwise_table(vectors, n_resamples=1000, confidence=0.95, seed=None):
+    """Paired bootstrap and approximate randomization tests between all pairs of inputs in `ErrorVectors`
+    that were checked against the same MRs, as a pandas DataFrame (one row per pair and metric)."""
+    import pandas as pd
+    rows = []
+    labels = vectors.labels()
+    for pos, label_a in enumerate(labels):
+        for label_b in labels[pos + 1:]:
+            if not vectors.paired(label_a, label_b):
+                continue
+            values_a, denoms = vectors.values(label_a)
+            values_b, _ = vectors.values(label_b)
+            boot = paired_bootstrap(values_a, values_b, denoms, n_resamples, confidence, seed)
+            rand = approximate_randomization(values_a, values_b, denoms, n_resamples, seed)
+            for metric in METRICS:
+                diff, lo, hi, p_boot = boot[metric]
+                rows.append(OrderedDict([('system_a', label_a), ('system_b', label_b), ('metric', metric),
+                                         ('diff', diff), ('diff_lo', lo), ('diff_hi', hi),
+                                         ('p_bootstrap', p_boot), ('p_randomization', rand[metric])]))
+    return pd.DataFrame(rows, columns=['system_a', 'system_b', 'metric', 'diff', 'diff_lo', 'diff_hi',
+                                       'p_bootstrap', 'p_randomization'])
+
+
+def sample_until_narrow(score, n_insts, width, batch_size=1000, n_resamples=1000, confidence=0.95, seed=None):
+    """Check random batches of instances until the bootstrap confidence interval of SemERR is at most
+    `width` wide (or all instances are checked). `score` is called with a list of instance indexes and
+    must return their `score_instances` results. Returns the indexes checked and their results."""
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(n_insts)
+    checked, results = [], []
+    for start in range(0, n_insts, batch_size):
+        batch = order[start:start + batch_size].tolist()
+        checked.extend(batch)
+        results.extend(score(batch))
+        vectors = ErrorVectors()
+        vectors.add('sample', [], results)
+        values, denoms = vectors.values('sample')
+        _, lower, upper = bootstrap_ci(values, denoms, n_resamples, confidence, seed)['semerr']
+        if upper - lower <= width:
+            break
+    return checked, results
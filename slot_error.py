@@ -5,13 +5,31 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from argparse import ArgumentParser
-import pandas as pd
 import re
 import codecs
+import hashlib
 import json
+import os
 import sys
-from tgen.data import DA
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+
+import e2e_mr
+
+# NB: pandas and other heavier modules are imported only where needed, to keep startup fast
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+try:
+    unichr
+except NameError:  # Python 3
+    unichr = chr
+
+timer = getattr(time, 'perf_counter', time.time)
 
 REALIZATIONS = {
     'area': {
@@ -202,35 +220,198 @@ REALIZATIONS = {
 }
 
 
+def pad_pattern(pat):
+    """Pad a pattern with \b (word boundary), unless it contains '^'/'$' (start/end)."""
+    return (r'\b' if not pat.startswith('^') else '') + pat + (r'\b' if not pat.endswith('$') else '')
+
+
 def compile_patterns(patterns):
     """Compile a list of patterns into one big option regex. Note that all of them will match whole words only."""
-    # pad intent patterns with \b (word boundary), unless they contain '^'/'$' (start/end)
-    return re.compile('|'.join([((r'\b' if not pat.startswith('^') else '') + pat +
-                                 (r'\b' if not pat.endswith('$') else ''))
-                                for pat in patterns]),
-                      re.I | re.UNICODE)
+    return re.compile('|'.join([pad_pattern(pat) for pat in patterns]), re.I | re.UNICODE)
 
-# store "proper" capitalization of the values
-CAPITALIZE = {}
-# compile realization patterns
-for slot in REALIZATIONS.keys():
-    if isinstance(REALIZATIONS[slot], list):
-        CAPITALIZE[slot] = {val.lower(): val for val in REALIZATIONS[slot]}
-        REALIZATIONS[slot] = compile_patterns(REALIZATIONS[slot])
-    else:
-        CAPITALIZE[slot] = {val.lower(): val for val in REALIZATIONS[slot].keys()}
-        for value in REALIZATIONS[slot].keys():
-            REALIZATIONS[slot][value] = compile_patterns(REALIZATIONS[slot][value])
+
+def _first_chars(parsed):
+    """Find the set of characters that a parsed regex (a sequence of sre_parse items) may start with.
+    Returns the set and a flag saying whether the sequence may match an empty string. The set is None
+    if it cannot be determined (the regex may start with anything)."""
+    first = set()
+    for op, av in parsed:
+        if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):  # zero-width, look further
+            continue
+        nullable = False
+        if op == sre_parse.LITERAL:
+            chars = set([unichr(av)])
+        elif op == sre_parse.IN:
+            chars = set()
+            for in_op, in_av in av:
+                if in_op == sre_parse.LITERAL:
+                    chars.add(unichr(in_av))
+                elif in_op == sre_parse.RANGE and in_av[1] - in_av[0] < 256:
+                    chars.update(unichr(code) for code in range(in_av[0], in_av[1] + 1))
+                else:  # negation, categories (\w etc.)
+                    return None, False
+        elif op == sre_parse.BRANCH:
+            chars = set()
+            for branch in av[1]:
+                branch_chars, branch_nullable = _first_chars(branch)
+                if branch_chars is None:
+                    return None, False
+                chars |= branch_chars
+                nullable = nullable or branch_nullable
+        elif op == sre_parse.SUBPATTERN:
+            chars, nullable = _first_chars(av[-1])
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            chars, nullable = _first_chars(av[2])
+            nullable = nullable or av[0] == 0
+        else:  # anything else (any char, backreferences...) -- don't know
+            return None, False
+        if chars is None:
+            return None, False
+        first |= chars
+        if not nullable:
+            return first, False
+    return first, True
+
+
+class Matcher(object):
+    """All realization patterns combined, so that matches for all slots and values are collected in
+    a single pass over the text.
+
+    Each slot value's pattern is wrapped in a capturing lookahead, so all of them can be tested at
+    a single position at once. The options of each pattern are bucketed by the first character they
+    may match, and only the bucket for the character at the given position is tried there. The result
+    is the same as calling `finditer` for each slot value's compiled pattern separately.
+
+    The regexes for the buckets are compiled on first use, so short inputs only pay for what they need.
+    """
+
+    def __init__(self, realizations):
+        # (slot, value) for each pattern; value is None for verbatim slots (value = matched text)
+        self.keys = []
+        self.options = options = []
+        for slot in realizations.keys():
+            if not isinstance(realizations[slot], dict):
+                self.keys.append((slot, None))
+                options.append([pad_pattern(pat) for pat in realizations[slot]])
+            else:
+                for value in realizations[slot].keys():
+                    self.keys.append((slot, CAPITALIZE[slot][value.lower()]))
+                    options.append([pad_pattern(pat) for pat in realizations[slot][value]])
+        self.group_names = ['p%d' % idx for idx in range(len(options))]
+
+        # find the ASCII characters each option may start with (None = any character)
+        ascii_chars = ''.join(unichr(code) for code in range(128))
+        starts = []
+        for pat_options in options:
+            starts.append([])
+            for option in pat_options:
+                first, nullable = _first_chars(sre_parse.parse(option, re.I | re.UNICODE))
+                if first is None or nullable:
+                    starts[-1].append(None)
+                    continue
+                # characters equivalent to the first characters, given case-insensitive matching
+                fold = re.compile('[%s]' % ''.join(re.escape(char) for char in first), re.I | re.UNICODE)
+                starts[-1].append(set(fold.findall(ascii_chars)))
+
+        # bucket with all options (for non-ASCII characters), and one bucket for each ASCII character
+        # with only the options that may start with it -- as tuples of (pattern index, option indexes)
+        self.all_options = tuple((idx, tuple(range(len(pat_options)))) for idx, pat_options in enumerate(options))
+        self.buckets = {}
+        for char in ascii_chars:
+            bucket = []
+            for idx, pat_starts in enumerate(starts):
+                opt_idxs = tuple(opt_idx for opt_idx, start in enumerate(pat_starts)
+                                 if start is None or char in start)
+                if opt_idxs:
+                    bucket.append((idx, opt_idxs))
+            if bucket:
+                self.buckets[char] = tuple(bucket)
+        self._compiled = {}  # bucket -> compiled regex + groups
+        self._regexes = {}  # character -> compiled regex + groups
+        self.candidates = self._compile_candidates(self.buckets)
+        # slots -> candidates regex + (character -> compiled regex + groups) with the slots' patterns only
+        self._slot_regexes = {}
+
+    def _compile_candidates(self, buckets):
+        """Compile the regex for candidate positions, given the buckets: word characters with a nonempty bucket,
+        any non-ASCII character; for other characters (mostly spaces and punctuation), directly check the options
+        that may start with them (all patterns start at word boundaries, unless anchored by '^')."""
+        cand_chars = ''.join(re.escape(char) for char in sorted(buckets.keys()) if re.match(r'\w', char))
+        cand_options = []
+        for char in sorted(buckets.keys()):
+            if not re.match(r'\w', char):
+                for pat_idx, opt_idxs in buckets[char]:
+                    cand_options.extend(self.options[pat_idx][opt_idx] for opt_idx in opt_idxs
+                                        if self.options[pat_idx][opt_idx] not in cand_options)
+        at_boundary = all(option.startswith(r'\b') for pat_options in self.options for option in pat_options)
+        alternatives = (['[%s]' % cand_chars] if cand_chars else []) + ['[^\x00-\x7f]'] + cand_options
+        return re.compile((r'\b' if at_boundary else '') + '(?=%s)' % '|'.join(alternatives), re.I | re.UNICODE)
+
+    def _slot_view(self, slots):
+        """Return the candidates regex, an empty regex cache, buckets and the all-options bucket restricted
+        to the patterns of the given slots (the bucket regexes are shared with other slot subsets)."""
+        buckets = {}
+        for char, bucket in self.buckets.items():
+            bucket = tuple((idx, opt_idxs) for idx, opt_idxs in bucket if self.keys[idx][0] in slots)
+            if bucket:
+                buckets[char] = bucket
+        all_options = tuple((idx, opt_idxs) for idx, opt_idxs in self.all_options if self.keys[idx][0] in slots)
+        return self._compile_candidates(buckets), {}, buckets, all_options
+
+    def _compile_bucket(self, bucket):
+        """Compile a regex with a capturing lookahead for each pattern in the bucket, given as a list of
+        (pattern index, option indexes). Returns the regex and the list of (pattern index, group number)."""
+        if bucket not in self._compiled:
+            regex = re.compile(''.join('(?:(?=(?P<%s>%s))|)' % (self.group_names[idx],
+                                                                 '|'.join(self.options[idx][opt_idx] for opt_idx in opt_idxs))
+                                       for idx, opt_idxs in bucket),
+                               re.I | re.UNICODE)
+            self._compiled[bucket] = regex, [(idx, regex.groupindex[self.group_names[idx]]) for idx, _ in bucket]
+        return self._compiled[bucket]
+
+    def find_all(self, text, slots=None):
+        """Find all slot value matches in the given text. Returns a list of `Match` objects, ordered
+        by slot and value (same order as in REALIZATIONS), then by position. If `slots` are given (as
+        a tuple), only the patterns of these slots are run (with candidate positions and bucket regexes
+        compiled for the given slots on first use), so only their matches are collected."""
+        found = [[] for _ in self.keys]
+        next_start = [0] * len(self.keys)  # emulate finditer: matches of one pattern don't overlap
+        if slots is None:
+            candidates, regexes, buckets, all_options = self.candidates, self._regexes, self.buckets, self.all_options
+        else:
+            if slots not in self._slot_regexes:
+                self._slot_regexes[slots] = self._slot_view(slots)
+            candidates, regexes, buckets, all_options = self._slot_regexes[slots]
+        for cand in candidates.finditer(text):
+            pos = cand.start()
+            try:
+                regex, groups = regexes[text[pos]]
+            except KeyError:
+                regex, groups = regexes[text[pos]] = self._compile_bucket(buckets.get(text[pos], all_options))
+            spans = regex.match(text, pos).regs
+            for idx, group in groups:
+                end = spans[group][1]
+                if end >= 0 and pos >= next_start[idx]:
+                    found[idx].append((pos, end))
+                    next_start[idx] = end if end > pos else end + 1
+        matches = []
+        for (slot, value), spans in zip(self.keys, found):
+            for start, end in spans:
+                matches.append(Match(slot, value if value is not None else CAPITALIZE[slot][text[start:end].lower()],
+                                     start, end))
+        return matches
 
 
 class Match(object):
     """Realization pattern match in the system output"""
 
-    def __init__(self, slot, value, regex_match):
+    __slots__ = ('slot', 'value', '_start', '_end')
+
+    def __init__(self, slot, value, start, end):
         self.slot = slot
         self.value = value
-        self._start = regex_match.start()
-        self._end = regex_match.end()
+        self._start = start
+        self._end = end
 
     def is_same_string(self, other):
         return (self._start == other._start and self._end == other._end)
@@ -249,49 +430,166 @@ class Match(object):
         return str(self)
 
 
-def reclassify_mr(ref, gold_mr=DA()):
+# store "proper" capitalization of the values
+CAPITALIZE = {}
+for slot in REALIZATIONS.keys():
+    if isinstance(REALIZATIONS[slot], list):
+        CAPITALIZE[slot] = {val.lower(): val for val in REALIZATIONS[slot]}
+    else:
+        CAPITALIZE[slot] = {val.lower(): val for val in REALIZATIONS[slot].keys()}
+
+# fingerprint of the patterns, to tell if cached results are still valid (in declaration order: the order
+# of slots and values decides between matches of the same span)
+PATTERNS_HASH = hashlib.sha1(json.dumps(REALIZATIONS).encode('utf-8')).hexdigest()
+# fingerprints of each slot's patterns (order matters, it decides between matches of the same span)
+SLOT_HASHES = {slot: hashlib.sha1(json.dumps(REALIZATIONS[slot]).encode('utf-8')).hexdigest()
+               for slot in REALIZATIONS.keys()}
+
+# combined matcher for all patterns, compiled on first use (see `get_matcher`)
+_MATCHER = None
+
+
+def get_matcher():
+    """Return the combined matcher for all realization patterns. The matcher is compiled on first call."""
+    global _MATCHER
+    if _MATCHER is None:
+        _MATCHER = Matcher(REALIZATIONS)
+    return _MATCHER
+
+
+def _more_selective(triggers, other):
+    """Return the more selective of two sets of trigger strings (longer shortest string), None = unknown."""
+    if triggers is None:
+        return other
+    if other is None:
+        return triggers
+    return triggers if min(len(trig) for trig in triggers) >= min(len(trig) for trig in other) else other
+
+
+def _triggers(parsed):
+    """Find a set of literal strings such that any match of the parsed regex (a sequence of sre_parse
+    items) contains at least one of them. Returns None if no such set can be found."""
+    best = None
+    run = ''  # current run of literal characters
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            run += unichr(av)
+            continue
+        if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):  # zero-width, run continues
+            continue
+        best = _more_selective(best, set([run]) if run else None)
+        run = ''
+        cand = None
+        if op == sre_parse.SUBPATTERN:
+            cand = _triggers(av[-1])
+        elif op == sre_parse.BRANCH:
+            cand = set()
+            for branch in av[1]:
+                branch_triggers = _triggers(branch)
+                if branch_triggers is None:
+                    cand = None
+                    break
+                cand |= branch_triggers
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] > 0:
+            cand = _triggers(av[2])
+        best = _more_selective(best, cand)
+    return _more_selective(best, set([run]) if run else None)
+
+
+def fold_case(text):
+    """Case-fold the text for caseless substring search, the same way as the regexes match with
+    re.IGNORECASE (incl. dotless i and dotted capital I matching i, which case folding alone does not do)."""
+    text = text.replace('\u0130', 'i')
+    return (text.casefold() if hasattr(text, 'casefold') else text.lower()).replace('\u0131', 'i')
+
+
+class Prefilter(object):
+    """Trigger strings for each slot, derived from the realization patterns, so that a quick caseless
+    substring search tells which slots may be mentioned in a text (see `ErrorThreshold`). Slots for which
+    no trigger strings can be found may always be mentioned."""
+
+    def __init__(self, realizations):
+        self.slots = list(realizations.keys())
+        self.triggers = {}
+        for slot in self.slots:
+            patterns = (realizations[slot] if not isinstance(realizations[slot], dict)
+                        else [pat for value in realizations[slot].keys() for pat in realizations[slot][value]])
+            triggers = set()
+            for pat in patterns:
+                pat_triggers = _triggers(sre_parse.parse(pat, re.I | re.UNICODE))
+                if pat_triggers is None:
+                    triggers = None
+                    break
+                triggers |= set(fold_case(trig) for trig in pat_triggers)
+            if triggers is not None:  # strings containing another trigger are redundant
+                triggers = sorted(trig for trig in triggers
+                                  if not any(other != trig and other in trig for other in triggers))
+            self.triggers[slot] = triggers
+
+
+def filter_matches(matches, mr_dict):
+    """Filter out matches that are substrings of other matches. Of matches with the same span, keep only
+    one: the one with the value in the gold-standard MR (given as a dict), if there's exactly one such;
+    none, if there are more; the first one, if there are none. Returns the remaining matches in their
+    original order.
+
+    Spans are processed sorted by start and decreasing end, so a span is contained in another one iff
+    any span before it ends at or after its end -- this runs in O(n log n)."""
+    # group matches by span
+    by_span = {}
+    for pos, match in enumerate(matches):
+        by_span.setdefault((match._start, match._end), []).append(pos)
+
+    keep = [False] * len(matches)
+    max_end = -1
+    for start, end in sorted(by_span.keys(), key=lambda span: (span[0], -span[1])):
+        if max_end >= end:  # substring of another match
+            continue
+        max_end = end
+        same_span = by_span[(start, end)]
+        gold = [pos for pos in same_span if matches[pos].value in mr_dict.get(matches[pos].slot, {})]
+        if len(gold) == 1:
+            keep[gold[0]] = True
+        elif not gold:
+            keep[same_span[0]] = True
+    return [match for match, keep_match in zip(matches, keep) if keep_match]
+
+
+def mr_to_dict(gold_mr):
+    """Convert a gold-standard MR (parsed by `e2e_mr.parse`, or a TGen DA) into the dict-based format
+    (slot -> value -> count)."""
+    mr_dict = {}
+    for slot, value in (e2e_mr.from_da(gold_mr) if gold_mr is not None else []):
+        mr_dict[slot] = mr_dict.get(slot, {})
+        val = CAPITALIZE[slot][value.lower()]
+        mr_dict[slot][val] = mr_dict[slot].get(val, 0) + 1
+    return mr_dict
+
+
+def reclassify_mr(ref, gold_mr=None, matches=None, mr_dict=None):
     """Classify the MR given a text. Can use a gold-standard MR to make the classification more
     precise (in case of ambiguity, goes with the gold-standard value). Returns a dict-based MR format
-    for the system output MR and the gold-standard MR."""
+    for the system output MR and the gold-standard MR. Matches of the realization patterns in the text
+    are found here, unless they are given (as returned by `Matcher.find_all` for all patterns).
+    The gold-standard MR may also be given already converted by `mr_to_dict` (it is not modified)."""
     # convert MR to dict for comparing & checking against
-    mr_dict = {}
-    for dai in gold_mr.dais:
-        mr_dict[dai.slot] = mr_dict.get(dai.slot, {})
-        val = CAPITALIZE[dai.slot][dai.value.lower()]
-        mr_dict[dai.slot][val] = mr_dict[dai.slot].get(val, 0) + 1
+    if mr_dict is None:
+        mr_dict = mr_to_dict(gold_mr)
 
     # create MR dict representation of the output text
     # first, collect all value matches
-    matches = []
-    for slot in REALIZATIONS.keys():
-        # verbatim slot
-        if not isinstance(REALIZATIONS[slot], dict):
-            matches.extend([Match(slot, CAPITALIZE[slot][match.group(0).lower()], match)
-                            for match in REALIZATIONS[slot].finditer(ref)])
-        # slot with variable realizations
-        else:
-            # collect all matches for all values
-            for value in REALIZATIONS[slot].keys():
-                matches.extend([Match(slot, CAPITALIZE[slot][value.lower()], match)
-                                for match in REALIZATIONS[slot][value].finditer(ref)])
+    matcher = get_matcher()
+    if matches is None:
+        matches = matcher.find_all(ref)
 
     # then filter out those that are substrings/duplicates (let only one value match,
     # preferrably the one indicated by the true MR -- check with the MR dict)
-    filt_matches = []
-    for match in matches:
-        skip = False
-        for other_match in matches:
-            if match is other_match:
-                continue
-            if (match.is_substring(other_match) or
-                (match.is_same_string(other_match) and
-                 (other_match.value in mr_dict.get(other_match.slot, {}).keys() or other_match in filt_matches))):
-                skip = True
-                break
-        if not skip:
-            filt_matches.append(match)
+    filt_matches = filter_matches(matches, mr_dict)
 
     # now put it all into a dict
+    # NB: counts only accumulate for the last value of the last slot, as left over from the original
+    # per-value matching loop; this is kept so that the results match the released cleaned data
+    value = matcher.keys[-1][1]
     out_dict = {}
     for match in filt_matches:
         out_dict[match.slot] = out_dict.get(match.slot, {})
@@ -345,84 +643,837 @@ def check_output(gold_mr, out_mr, fix_type='all'):
             missing += max(mr_not_out - out_not_mr, 0)
             added += max(out_not_mr - mr_not_out, 0)
 
-    diff = json.dumps({slot: vals for slot, vals in diff.items() if vals})
+    diff = json.dumps({slot: vals for slot, vals in diff.items() if vals}, sort_keys=True)
     return added, missing, valerr, repeated, diff, out_mr
 
 
+class CountEncoder(object):
+    """Dict-based MRs encoded as count matrices (one row per MR, one column per slot value,
+    values of the same slot in adjacent columns), over all values given in REALIZATIONS."""
+
+    def __init__(self):
+        self.slots = list(CAPITALIZE.keys())
+        self.values = [(slot, value) for slot in self.slots for value in CAPITALIZE[slot].values()]
+        self.index = {slot_value: col for col, slot_value in enumerate(self.values)}
+        self.slot_starts = [[slot for slot, _ in self.values].index(slot) for slot in self.slots]
+        self.col_slots = [self.slots.index(slot) for slot, _ in self.values]
+
+    def encode(self, mr_dicts):
+        import numpy as np
+        counts = np.zeros((len(mr_dicts), len(self.values)), dtype=np.int64)
+        for row, mr_dict in enumerate(mr_dicts):
+            for slot, values in mr_dict.items():
+                for value, count in values.items():
+                    counts[row, self.index[(slot, value)]] = count
+        return counts
+
+    def decode(self, counts, key_orders=None):
+        """Decode count matrix rows into dict-based MRs. If `key_orders` are given (a list of dict-based MRs
+        for each row), values are put into the dicts in the order they appear there (then in the vocabulary
+        order)."""
+        mr_dicts = []
+        for row_no, row in enumerate(counts):
+            cols = row.nonzero()[0].tolist()
+            if key_orders:
+                order = {}
+                for mr_dict in key_orders[row_no]:
+                    for slot, values in mr_dict.items():
+                        for value in values:
+                            order.setdefault((slot, value), len(order))
+                cols.sort(key=lambda col: order.get(self.values[col], len(order) + col))
+            mr_dict = {}
+            for col in cols:
+                slot, value = self.values[col]
+                mr_dict.setdefault(slot, {})[value] = int(row[col])
+            mr_dicts.append(mr_dict)
+        return mr_dicts
+
+    def slot_sums(self, counts):
+        """Sum the counts of all values for each slot."""
+        import numpy as np
+        return np.add.reduceat(counts, self.slot_starts, axis=1)
+
+    def slot_mask(self, slot_mask):
+        """Expand a per-slot boolean mask to all values of the slots."""
+        return slot_mask[:, self.col_slots]
+
+
+def check_outputs(encoder, gold_counts, out_counts, fix_types=('all',)):
+    """Batch version of `check_output` for MRs encoded as count matrices by a `CountEncoder`.
+    Computes the results for all the given fix types at once. Returns a dict keyed by fix type, with
+    arrays of added, missing, wrong-value and repeated counts and matrices of MR diffs (output count
+    minus gold count) and fixed output MRs."""
+    import numpy as np
+    # slots present in gold MR/output
+    gold_slot = encoder.slot_mask(encoder.slot_sums(gold_counts) > 0)
+    out_slot = encoder.slot_mask(encoder.slot_sums(out_counts) > 0)
+    gold_only = gold_slot & ~out_slot
+    out_only = out_slot & ~gold_slot
+    both = gold_slot & out_slot
+    # remove repeated first (check if MR has same val less than out + same value more than 1x)
+    rep = np.where(both & (gold_counts > 0) & (out_counts > gold_counts), out_counts - gold_counts, 0)
+    repeated = rep.sum(axis=1)
+    out_counts = out_counts - rep
+    # the difference in the # of value occurrences, for slots in both MR and output
+    val_diff = np.where(both, gold_counts - out_counts, 0)
+
+    results = {}
+    for fix_type in fix_types:
+        fix_missing = fix_type == 'all' or 'missing' in fix_type
+        fix_added = fix_type == 'all' or 'added' in fix_type
+        fixed = out_counts.copy()
+        diff = np.zeros_like(out_counts)
+        mr_not_out = np.where(val_diff > 0, val_diff, 0)
+        out_not_mr = np.where(val_diff < 0, -val_diff, 0)
+        if fix_missing:
+            missing = np.where(gold_only, gold_counts, 0).sum(axis=1)
+            diff -= np.where(gold_only, gold_counts, 0)
+        else:  # ignore missing stuff -- adjust output MR
+            missing = np.zeros(len(gold_counts), dtype=np.int64)
+            fixed = np.where(gold_only, gold_counts, fixed) + mr_not_out
+            mr_not_out = np.zeros_like(mr_not_out)
+        if fix_added:
+            added = np.where(out_only, out_counts, 0).sum(axis=1)
+            diff += np.where(out_only, out_counts, 0)
+        else:  # ignore added stuff -- adjust output MR (NB: same as in check_output)
+            added = np.zeros(len(gold_counts), dtype=np.int64)
+            fixed = np.where(out_only, 0, fixed) + out_not_mr
+            out_not_mr = np.zeros_like(out_not_mr)
+        diff += out_not_mr - mr_not_out
+        mr_not_out = encoder.slot_sums(mr_not_out)
+        out_not_mr = encoder.slot_sums(out_not_mr)
+        # value errors up to the same # of values, others fall under missing & added
+        valerr = np.minimum(mr_not_out, out_not_mr).sum(axis=1)
+        missing = missing + np.maximum(mr_not_out - out_not_mr, 0).sum(axis=1)
+        added = added + np.maximum(out_not_mr - mr_not_out, 0).sum(axis=1)
+        results[fix_type] = (added, missing, valerr, repeated, diff, fixed)
+    return results
+
+
+def _reclassify_mr_args(args):
+    """`reclassify_mr` with all arguments in one tuple, to be used with `Pool.map`."""
+    return reclassify_mr(*args)
+
+
+def score_instances_multi(mrs, refs, fix_types, pool=None, cache=None):
+    """Check all instances (gold MRs + refs) for multiple fix types at once, with a single pass of
+    pattern matching and batch computation of the errors. Returns a dict of lists of `score_instance`
+    results, keyed by fix type. If a process pool is given, pattern matching runs in parallel.
+    If a `ResultCache` is given, only instances not found in the cache for all fix types are checked."""
+    if cache is not None:
+        keys = {fix_type: [cache.key(mr, ref, fix_type) for mr, ref in zip(mrs, refs)] for fix_type in fix_types}
+        results = {fix_type: [cache.get(key) for key in keys[fix_type]] for fix_type in fix_types}
+        # check each distinct instance missing for any fix type just once, for all of them
+        todo = {}
+        for pos in range(len(refs)):
+            if any(results[fix_type][pos] is None for fix_type in fix_types):
+                todo.setdefault(keys[fix_types[0]][pos], pos)
+        cache.hits += (len(refs) - len(todo)) * len(fix_types)
+        cache.misses += len(todo) * len(fix_types)
+        todo = sorted(todo.values())
+        if todo:
+            new_results = score_instances_multi([mrs[pos] for pos in todo], [refs[pos] for pos in todo],
+                                                fix_types, pool)
+            for fix_type in fix_types:
+                new = {keys[fix_type][pos]: result for pos, result in zip(todo, new_results[fix_type])}
+                for key, result in new.items():
+                    cache.put(key, result)
+                results[fix_type] = [result if result is not None else new[key]
+                                     for key, result in zip(keys[fix_type], results[fix_type])]
+            cache.commit()
+        return results
+
+    if pool is None or len(refs) <= 1:
+        mr_dicts = [reclassify_mr(ref, mr) for mr, ref in zip(mrs, refs)]
+    else:
+        mr_dicts = pool.map(_reclassify_mr_args, list(zip(refs, mrs)))
+    encoder = CountEncoder()
+    out_counts = encoder.encode([out_mr for out_mr, _ in mr_dicts])
+    gold_counts = encoder.encode([gold_mr for _, gold_mr in mr_dicts])
+    mr_lens = [len(e2e_mr.from_da(mr)) for mr in mrs]
+    results = {}
+    for fix_type, (added, missing, valerr, repeated, diff, fixed) in check_outputs(encoder, gold_counts, out_counts,
+                                                                                   fix_types).items():
+        diffs = [json.dumps(diff_dict, sort_keys=True) for diff_dict in encoder.decode(diff)]
+        fixed_mrs = [format_mr(fixed_dict) for fixed_dict in encoder.decode(fixed, mr_dicts)]
+        results[fix_type] = list(zip(added.tolist(), missing.tolist(), valerr.tolist(), repeated.tolist(),
+                                     mr_lens, diffs, fixed_mrs))
+    return results
+
+
+# gold MR dicts for `score_nbest` and `ErrorThreshold`, keyed by parsed MR
+_GOLD_DICTS = {}
+
+
+def gold_dict(mr):
+    """Return the gold MR (a string, parsed by `e2e_mr.parse` or a TGen DA) converted by `mr_to_dict`,
+    memoized (the dict is shared, it must not be modified)."""
+    mr = e2e_mr.from_da(mr)
+    if not isinstance(mr, tuple):
+        mr = e2e_mr.parse(mr)
+    mr_dict = _GOLD_DICTS.get(mr)
+    if mr_dict is None:
+        if len(_GOLD_DICTS) >= e2e_mr.MEMO_SIZE:
+            _GOLD_DICTS.clear()
+        mr_dict = _GOLD_DICTS[mr] = mr_to_dict(mr)
+    return mr_dict
+
+
+def score_nbest(mr, candidates, fix_type='all'):
+    """Score a list of candidate texts (e.g. an n-best list from beam search) against a single gold MR,
+    given as a string or parsed by `e2e_mr.parse`. The gold MR is converted just once (and memoized), and
+    repeated candidates are only checked once. Returns a list of (added, missing, valerr, repeated) for
+    each candidate and a list of candidate indexes ranked by the total number of errors (ties keep the
+    original order)."""
+    mr_dict = gold_dict(mr)
+    checked = {}
+    counts = []
+    for cand in candidates:
+        if cand not in checked:
+            out_mr, _ = reclassify_mr(cand, mr_dict=mr_dict)
+            checked[cand] = check_output(mr_dict, out_mr, fix_type)[:4]
+        counts.append(checked[cand])
+    ranking = sorted(range(len(counts)), key=lambda idx: sum(counts[idx]))
+    return counts, ranking
+
+
+def count_errors(gold_mr, out_mr, fix_type='all', max_errors=None, slot_order=None):
+    """Count the errors in the system output -- the sum of added, missing, wrong-value and repeated counts
+    as returned by `check_output`, but without building the MR diff and fixed MR (`out_mr` is not modified).
+    Slots of the gold MR are checked first (in the order of `slot_order`, if given, which must list all
+    slots), then the other slots.
+    With `max_errors`, stops as soon as the count exceeds it or the remaining slots cannot get it above,
+    so the result is exact only in relation to `max_errors`."""
+    count_missing = fix_type == 'all' or 'missing' in fix_type
+    count_added = fix_type == 'all' or 'added' in fix_type
+    slots = [slot for slot in slot_order if slot in gold_mr] if slot_order else list(gold_mr.keys())
+    slots.extend(slot for slot in out_mr.keys() if slot not in gold_mr)
+    gold_sizes = {slot: sum(values.values()) for slot, values in gold_mr.items()}
+    out_sizes = {slot: sum(values.values()) for slot, values in out_mr.items()}
+    bound = sum(gold_sizes.values()) + sum(out_sizes.values())  # max. errors in the remaining slots
+    errors = 0
+    for slot in slots:
+        if slot not in out_mr:
+            slot_errors = gold_sizes[slot] if count_missing else 0
+        elif slot not in gold_mr:
+            slot_errors = out_sizes[slot] if count_added else 0
+        else:
+            # same as in `check_output`: repeated values first, then the rest of the diff
+            gold_vals, out_vals = gold_mr[slot], out_mr[slot]
+            repeated, mr_not_out, out_not_mr = 0, 0, 0
+            for val, count in out_vals.items():
+                if val not in gold_vals:
+                    out_not_mr += count
+                elif count > gold_vals[val]:
+                    repeated += count - gold_vals[val]
+            for val, count in gold_vals.items():
+                if count > out_vals.get(val, 0):
+                    mr_not_out += count - out_vals.get(val, 0)
+            slot_errors = repeated + max(mr_not_out if count_missing else 0, out_not_mr if count_added else 0)
+        errors += slot_errors
+        bound -= gold_sizes.get(slot, 0) + out_sizes.get(slot, 0)
+        if max_errors is not None and (errors > max_errors or errors + bound <= max_errors):
+            break
+    return errors
+
+
+class ErrorThreshold(object):
+    """Early-exit check whether texts have more than `max_errors` errors (counted as by `count_errors`),
+    for filtering data or pruning beams. Gold MR slots none of whose trigger strings (see `Prefilter`)
+    occur in the text cannot be matched and must be missing, so the check stops before any pattern
+    matching if these alone exceed the limit. Slots that were found missing most often so far are
+    tried first. Otherwise, the errors are counted after matching with `count_errors`."""
+
+    def __init__(self, max_errors=0, fix_type='all'):
+        self.max_errors = max_errors
+        self.fix_type = fix_type
+        self.count_missing = fix_type == 'all' or 'missing' in fix_type
+        self.prefilter = Prefilter(REALIZATIONS)
+        self.slot_order = list(REALIZATIONS.keys())
+        self.slot_missing = {slot: 0 for slot in self.slot_order}
+        self.checked, self.over, self.early = 0, 0, 0
+
+    def exceeds(self, mr, ref):
+        """Return True if the text has more than `max_errors` errors, given the gold MR (a string or
+        parsed by `e2e_mr.parse`)."""
+        mr_dict = gold_dict(mr)
+        self.checked += 1
+        if self.count_missing:
+            text = fold_case(ref)
+            missing = 0
+            for slot in self.slot_order:
+                triggers = self.prefilter.triggers[slot]
+                if slot not in mr_dict or triggers is None or any(trig in text for trig in triggers):
+                    continue
+                self.slot_missing[slot] += 1
+                missing += sum(mr_dict[slot].values())
+                if missing > self.max_errors:
+                    break
+            if missing:
+                self.slot_order.sort(key=lambda slot: -self.slot_missing[slot])
+            if missing > self.max_errors:
+                self.early += 1
+                self.over += 1
+                return True
+        out_mr, _ = reclassify_mr(ref, mr_dict=mr_dict)
+        over = count_errors(mr_dict, out_mr, self.fix_type, self.max_errors, self.slot_order) > self.max_errors
+        self.over += over
+        return over
+
+    def report(self, out=sys.stdout):
+        print("Over threshold (> %d errors): %5d / %5d = %.4f, decided before matching: %5d" %
+              (self.max_errors, self.over, self.checked, self.over / float(self.checked or 1), self.early), file=out)
+
+
 def load_lines(filename):
     with codecs.open(filename, 'r', 'UTF-8') as fh:
         lines = [line.strip() for line in fh.readlines()]
     return lines
 
 
-def process_file(filename, dump=None, fix=None, fix_type='all', out=sys.stdout, mrs=None):
-    """Analyze a single file, optionally dump per-instance stats to a TSV.
-    Will print to the `out` file provided (defaults to stdout)."""
+def read_input(filename, mrs=None, chunk_size=None):
+    """Read a CSV/TSV input file, or a TXT file with one output per line if MRs are given separately
+    (raises a ValueError if the number of lines does not match the number of MRs). Yields the input in chunks of `chunk_size` instances (or all at once if `chunk_size` is not set),
+    each as a tuple of data frame (None for TXT files), MR and ref column names, raw MR strings,
+    parsed MRs, and refs."""
     if mrs:
-        raw_mrs = [mr.to_diligent_da_string() for mr in mrs]
-        refs = load_lines(filename)
         mr_col = 'mr'
         ref_col = 'ref'
-        df = pd.DataFrame({mr_col: raw_mrs, ref_col: refs})
-    else:
-        # read input from CSV or TSV
         with codecs.open(filename, 'r', 'UTF-8') as fh:
-            line = fh.readline()
-            sep = "\t" if "\t" in line else ","
-        df = pd.read_csv(filename, sep=sep, encoding="UTF-8")
+            lines = (line.strip() for line in fh)
+            offset = 0
+            while True:
+                refs = list(islice(lines, chunk_size))
+                # the whole file must be paired with the MRs (checked before any outputs of the last chunk)
+                last = not chunk_size or len(refs) < chunk_size
+                if offset + len(refs) > len(mrs) or (last and offset + len(refs) != len(mrs)):
+                    raise ValueError('%s has %d lines, but there are %d MRs' %
+                                     (filename, offset + len(refs) + sum(1 for _ in lines), len(mrs)))
+                if offset and not refs:
+                    break
+                chunk_mrs = [e2e_mr.from_da(mr) for mr in mrs[offset:offset + len(refs)]]
+                raw_mrs = [e2e_mr.to_string(mr) for mr in chunk_mrs]
+                yield None, mr_col, ref_col, raw_mrs, chunk_mrs, refs
+                offset += len(refs)
+                if not chunk_size or not refs:
+                    break
+    elif _INPUT_CACHE is not None:
+        columns = load_cached_input(filename)
+        vocab = [tuple(slot_value) for slot_value in columns['meta']['vocab']]
+        step = chunk_size or max(len(columns['refs']), 1)
+        for start in range(0, max(len(columns['refs']), 1), step):
+            yield (None, columns['meta']['mr_col'], columns['meta']['ref_col'],
+                   columns['raw_mrs'][start:start + step], decode_mrs(columns['mrs'][start:start + step], vocab),
+                   columns['refs'][start:start + step])
+    else:
+        for chunk in _read_table(filename, chunk_size):
+            yield chunk
+
+
+def _read_table(filename, chunk_size=None):
+    """Read a CSV/TSV input file, yield chunks in the same format as `read_input`."""
+    import pandas as pd
+    # read input from CSV or TSV
+    with codecs.open(filename, 'r', 'UTF-8') as fh:
+        line = fh.readline()
+        sep = "\t" if "\t" in line else ","
+    if chunk_size:
+        dfs = pd.read_csv(filename, sep=sep, encoding="UTF-8", chunksize=chunk_size)
+    else:
+        dfs = [pd.read_csv(filename, sep=sep, encoding="UTF-8")]
+    for df in dfs:
         # accept column names used in the dataset itself and in system outputs
         mr_col = 'MR' if 'MR' in df.columns else 'mr'
         ref_col = 'output' if 'output' in df.columns else 'ref'
         raw_mrs = list(df[mr_col])
-        mrs = [DA.parse_diligent_da(mr) for mr in raw_mrs]  # parse MRs
+        chunk_mrs = [e2e_mr.parse(mr) for mr in raw_mrs]  # parse MRs
         refs = list(df[ref_col])
+        yield df, mr_col, ref_col, raw_mrs, chunk_mrs, refs
+
+
+# format version of the columnar files (see `save_columns`)
+COLUMNS_VERSION = 1
+
+
+class StringColumn(object):
+    """A column of strings stored as concatenated UTF-8 bytes and offsets (NumPy arrays, which may be
+    memory-mapped). Strings are decoded on access; slices return lists."""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def encode(strings):
+        """Encode a list of strings, return the bytes and offsets arrays."""
+        import numpy as np
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
 
-    # count the statistics
-    added, missing, valerr, repeated, mr_len, diffs, fixed_mrs = [], [], [], [], [], [], []
-    tot_ok, tot_m, tot_a, tot_ma = 0, 0, 0, 0
-    for mr, ref in zip(mrs, refs):
-        # check the text (classify MR)
-        out_mr, gold_mr = reclassify_mr(ref, mr)
-        # build a MR diff
-        inst_a, inst_m, inst_v, inst_r, diff, out_mr = check_output(gold_mr, out_mr, fix_type)
-        # just add the totals
-        if (inst_a and inst_m) or inst_v:
-            tot_ma += 1
-        elif inst_a or inst_r:
-            tot_a += 1
-        elif inst_m:
-            tot_m += 1
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[pos] for pos in range(*idx.indices(len(self)))]
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        return (self[pos] for pos in range(len(self)))
+
+
+def save_columns(directory, columns, meta=None):
+    """Save columns (a dict of NumPy arrays or lists of strings) into a directory of `.npy` files, with
+    `meta` (JSON-serializable) stored in `meta.json`, which is written last (marks the directory complete)."""
+    import numpy as np
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    types = {}
+    for name, column in columns.items():
+        if isinstance(column, np.ndarray):
+            np.save(os.path.join(directory, name + '.npy'), column)
+            types[name] = 'array'
         else:
-            tot_ok += 1
-        added.append(inst_a)
-        missing.append(inst_m)
-        valerr.append(inst_v)
-        repeated.append(inst_r)
-        diffs.append(diff)
-        mr_len.append(len(mr))
-        fixed_mr = DA.parse_dict(out_mr)
-        fixed_mr.dais.sort(key=lambda dai: ['name', 'eat_type', 'food', 'price_range', 'rating', 'area', 'family_friendly', 'near'].index(dai.slot))  # same order as E2E NLG data
-        fixed_mr = re.sub(r'rating\[', r'customer rating[', fixed_mr.to_diligent_da_string())
-        fixed_mr = re.sub(r'_([a-z])', lambda match: match.group(1).upper(), fixed_mr)  # price_range -> priceRange
-        fixed_mrs.append(fixed_mr)
-
-
-    # print the statistics
-    print(filename, file=out)
-    print("A: %5d, M: %5d, V: %5d, R: %5d, L: %5d" %
-          (sum(added), sum(missing), sum(valerr), sum(repeated), sum(mr_len)), file=out)
-    semerr = (sum(added) + sum(missing) + sum(valerr) + sum(repeated)) / float(sum(mr_len))
-    insrate = sum(added) / float(sum(mr_len))
-    delrate = sum(missing) / float(sum(mr_len))
-    wvlrate = sum(valerr) / float(sum(mr_len))
-    print("SemERR = %.4f [InsRate = %.4f, DelRate = %.4f, WVlRate = %.4f]" % (semerr, insrate, delrate, wvlrate), file=out)
-    print("InstOK : %5d / %5d = %.4f" % (tot_ok,  len(refs), tot_ok / float(len(refs))), file=out)
-    print("InstAdd: %5d / %5d = %.4f" % (tot_a,  len(refs), tot_a / float(len(refs))), file=out)
-    print("InstMis: %5d / %5d = %.4f" % (tot_m,  len(refs), tot_m / float(len(refs))), file=out)
-    print("InstM+A: %5d / %5d = %.4f" % (tot_ma,  len(refs), tot_ma / float(len(refs))), file=out)
-
-    print("Fixed MR String identical to original in %d cases." % sum(orig_mr == fixed_mr for orig_mr, fixed_mr in zip(raw_mrs, fixed_mrs)))
+            data, offsets = StringColumn.encode(column)
+            np.save(os.path.join(directory, name + '.bytes.npy'), data)
+            np.save(os.path.join(directory, name + '.offsets.npy'), offsets)
+            types[name] = 'strings'
+    with codecs.open(os.path.join(directory, 'meta.json'), 'w', 'UTF-8') as fh:
+        json.dump({'version': COLUMNS_VERSION, 'columns': types, 'meta': meta or {}}, fh)
+
+
+def load_columns(directory, mmap=True):
+    """Load columns saved by `save_columns`, memory-mapped unless `mmap` is False. Returns a dict of NumPy
+    arrays and `StringColumn`s, with the metadata under 'meta'. Returns None if the directory does not
+    contain (complete) columns of the current version."""
+    import numpy as np
+    try:
+        with codecs.open(os.path.join(directory, 'meta.json'), 'r', 'UTF-8') as fh:
+            meta = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('version') != COLUMNS_VERSION:
+        return None
+    mmap_mode = 'r' if mmap else None
+    columns = {'meta': meta['meta']}
+    for name, col_type in meta['columns'].items():
+        if col_type == 'array':
+            columns[name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+        else:
+            columns[name] = StringColumn(np.load(os.path.join(directory, name + '.bytes.npy'), mmap_mode=mmap_mode),
+                                         np.load(os.path.join(directory, name + '.offsets.npy'), mmap_mode=mmap_mode))
+    return columns
+
+
+def encode_mrs(mrs):
+    """Encode parsed MRs as a matrix of (slot, value) codes (one row per MR, padded with -1), return
+    the matrix and the list of (slot, value) for the codes."""
+    import numpy as np
+    index = {}
+    codes = np.full((len(mrs), max([len(mr) for mr in mrs] or [0])), -1, dtype=np.int32)
+    for row, mr in enumerate(mrs):
+        for col, slot_value in enumerate(mr):
+            codes[row, col] = index.setdefault(slot_value, len(index))
+    return codes, [list(slot_value) for slot_value in sorted(index, key=index.get)]
+
+
+def decode_mrs(codes, vocab):
+    """Decode MRs encoded by `encode_mrs` (`vocab` as a list of (slot, value) tuples)."""
+    return [tuple(vocab[code] for code in row if code >= 0) for row in codes.tolist()]
+
+
+# directory for the columnar cache of parsed inputs (see `set_input_cache`), None = no caching
+_INPUT_CACHE = None
+
+
+def set_input_cache(directory):
+    """Cache parsed CSV/TSV inputs and MR files in the given directory (None = no caching)."""
+    global _INPUT_CACHE
+    _INPUT_CACHE = directory
 
+
+def _input_cache_dir(filename):
+    stat = os.stat(filename)
+    key = json.dumps([os.path.abspath(filename), stat.st_size, stat.st_mtime])
+    return os.path.join(_INPUT_CACHE, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def load_cached_input(filename):
+    """Load a parsed CSV/TSV input file (raw MRs, encoded parsed MRs, refs) from the input cache,
+    memory-mapped. Reads, parses and stores it first if not cached yet (or changed since)."""
+    cache_dir = _input_cache_dir(filename)
+    columns = load_columns(cache_dir)
+    if columns is None:
+        raw_mrs, mrs, refs = [], [], []
+        for _, mr_col, ref_col, chunk_raw_mrs, chunk_mrs, chunk_refs in _read_table(filename):
+            raw_mrs.extend(chunk_raw_mrs)
+            mrs.extend(chunk_mrs)
+            refs.extend(chunk_refs)
+        codes, vocab = encode_mrs(mrs)
+        save_columns(cache_dir, {'raw_mrs': raw_mrs, 'mrs': codes, 'refs': refs},
+                     {'filename': filename, 'mr_col': mr_col, 'ref_col': ref_col, 'vocab': vocab})
+        columns = load_columns(cache_dir)
+    return columns
+
+
+def load_mrs(filename):
+    """Load and parse an MR file (one MR per line), using the input cache if set."""
+    if _INPUT_CACHE is None:
+        return [e2e_mr.parse(line) for line in load_lines(filename)]
+    cache_dir = _input_cache_dir(filename)
+    columns = load_columns(cache_dir)
+    if columns is None:
+        codes, vocab = encode_mrs([e2e_mr.parse(line) for line in load_lines(filename)])
+        save_columns(cache_dir, {'mrs': codes}, {'filename': filename, 'vocab': vocab})
+        columns = load_columns(cache_dir)
+    return decode_mrs(columns['mrs'], [tuple(slot_value) for slot_value in columns['meta']['vocab']])
+
+
+def write_columns_dump(directory, raw_mrs, refs, results):
+    """Save per-instance results into a columnar directory (see `save_columns`): MR, ref, fixed MR,
+    the error counts and MR length, and the MR diffs as a count matrix (output count minus gold count,
+    columns listed under 'diff_columns' in the metadata)."""
+    import numpy as np
+    encoder = CountEncoder()
+    added, missing, valerr, repeated, mr_len, diffs, fixed_mrs = [list(col) for col in zip(*results)] or [[]] * 7
+    diff_dicts = [json.loads(diff) for diff in diffs]
+    save_columns(directory, {'mr': raw_mrs, 'ref': refs, 'fixed_mr': fixed_mrs,
+                             'added': np.array(added, dtype=np.int32), 'missing': np.array(missing, dtype=np.int32),
+                             'valerr': np.array(valerr, dtype=np.int32), 'repeated': np.array(repeated, dtype=np.int32),
+                             'mr_len': np.array(mr_len, dtype=np.int32),
+                             'diff': encoder.encode(diff_dicts).astype(np.int16)},
+                 {'diff_columns': [list(slot_value) for slot_value in encoder.values]})
+
+
+def score_instance(mr, ref, fix_type='all'):
+    """Check a single instance (gold MR + ref), return the numbers of added, missing, wrong-value
+    and repeated slots, MR length, MR diff and fixed MR string."""
+    mr = e2e_mr.from_da(mr)
+    # check the text (classify MR)
+    out_mr, gold_mr = reclassify_mr(ref, mr)
+    # build a MR diff
+    inst_a, inst_m, inst_v, inst_r, diff, out_mr = check_output(gold_mr, out_mr, fix_type)
+    return inst_a, inst_m, inst_v, inst_r, len(mr), diff, format_mr(out_mr)
+
+
+def format_mr(mr_dict):
+    """Convert a dict-based MR into a string in the E2E data format."""
+    return e2e_mr.format_dict(mr_dict)  # same order as E2E NLG data, priceRange, customer rating etc.
+
+
+def _score_instance_args(args):
+    """`score_instance` with all arguments in one tuple, to be used with `Pool.map`."""
+    return score_instance(*args)
+
+
+class ResultCache(object):
+    """Cache of `score_instance` results, keyed by the ref, gold MR and fix type. Keeps the most
+    recently used results in memory, optionally backed by a SQLite file that persists across runs.
+    The file is cleared whenever the realization patterns change (results are only valid for the
+    patterns they were computed with)."""
+
+    def __init__(self, max_size=100000, filename=None):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.db = None
+        if filename:
+            import sqlite3
+            self.db = sqlite3.connect(filename)
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT)')
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'patterns'").fetchone()
+            if row is None or row[0] != PATTERNS_HASH:
+                self.db.execute('DELETE FROM results')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('patterns', ?)", (PATTERNS_HASH,))
+            self.db.commit()
+
+    @staticmethod
+    def key(mr, ref, fix_type):
+        """Cache key for the given gold MR (parsed), ref and fix type."""
+        key = json.dumps([e2e_mr.to_string(mr), ref, fix_type])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached result for the given key, None if not found."""
+        result = self.memory.pop(key, None)
+        if result is None and self.db is not None:
+            row = self.db.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+            result = tuple(json.loads(row[0])) if row is not None else None
+        if result is not None:
+            self._store(key, result)
+        return result
+
+    def put(self, key, result):
+        """Store a new result."""
+        self._store(key, result)
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?)', (key, json.dumps(result)))
+
+    def _store(self, key, result):
+        # (re-)insert as the most recently used, drop the least recently used if full
+        self.memory[key] = result
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def commit(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def report(self, out=sys.stdout):
+        total = self.hits + self.misses
+        print("Cache hits: %5d / %5d = %.4f" % (self.hits, total, self.hits / float(total or 1)), file=out)
+
+
+class IncrementalStore(object):
+    """Pattern matches and results stored across runs in a SQLite file, for quick re-checking after
+    the realization patterns are edited. Matches are stored for each text and slot along with the hash
+    of the slot's patterns, so only the slots whose patterns changed are matched again. Results are
+    stored for each instance along with the matches they were computed from, and only recomputed if
+    the matches differ. Instances whose results changed are collected as flips (see `write_flips`)."""
+
+    def __init__(self, filename):
+        import sqlite3
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS matches (text TEXT, slot TEXT, hash TEXT, matches TEXT, ' +
+                        'PRIMARY KEY (text, slot))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, matches TEXT, result TEXT)')
+        self.db.commit()
+        self.slots_matched, self.slots_total = 0, 0
+        self.recomputed, self.total = 0, 0
+        self.flips = []  # (label, position, MR, ref, old result, new result)
+        self.flipped = {}  # key -> old result for instances that flipped in this run
+
+    def find_all(self, ref):
+        """Return all pattern matches in the text, same as `Matcher.find_all`, matching only the slots
+        whose stored matches are missing or outdated."""
+        text_key = hashlib.sha1(ref.encode('utf-8')).hexdigest()
+        stored = {slot: (slot_hash, json.loads(slot_matches)) for slot, slot_hash, slot_matches in
+                  self.db.execute('SELECT slot, hash, matches FROM matches WHERE text = ?', (text_key,))}
+        todo = tuple(slot for slot in REALIZATIONS.keys() if stored.get(slot, (None,))[0] != SLOT_HASHES[slot])
+        self.slots_matched += len(todo)
+        self.slots_total += len(REALIZATIONS)
+        if todo:
+            found = {slot: [] for slot in todo}
+            for match in get_matcher().find_all(ref, todo):
+                found[match.slot].append([match.value, match._start, match._end])
+            for slot in todo:
+                stored[slot] = (SLOT_HASHES[slot], found[slot])
+                self.db.execute('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?)',
+                                (text_key, slot, SLOT_HASHES[slot], json.dumps(found[slot])))
+        return [Match(slot, value, start, end) for slot in REALIZATIONS.keys() for value, start, end in stored[slot][1]]
+
+    def score(self, mrs, refs, fix_type='all', label=None, offset=0):
+        """Check all instances (gold MRs + refs), return a list of `score_instance` results. Instances
+        are labelled with `label` (e.g. file name) and their position (from `offset`) in flips."""
+        results = []
+        for pos, (mr, ref) in enumerate(zip(mrs, refs), start=offset):
+            matches = self.find_all(ref)
+            signature = json.dumps([[match.slot, match.value, match._start, match._end] for match in matches])
+            key = ResultCache.key(mr, ref, fix_type)
+            row = self.db.execute('SELECT matches, result FROM results WHERE key = ?', (key,)).fetchone()
+            self.total += 1
+            if row is not None and row[0] == signature:
+                result = tuple(json.loads(row[1]))
+                if key in self.flipped:  # repeated instance, already recomputed in this run
+                    self.flips.append((label, pos, e2e_mr.to_string(mr), ref, self.flipped[key], result))
+                results.append(result)
+                continue
+            out_mr, gold_mr = reclassify_mr(ref, mr, matches)
+            inst_a, inst_m, inst_v, inst_r, diff, out_mr = check_output(gold_mr, out_mr, fix_type)
+            result = (inst_a, inst_m, inst_v, inst_r, len(mr), diff, format_mr(out_mr))
+            self.recomputed += 1
+            if row is not None and tuple(json.loads(row[1])) != result:
+                self.flipped[key] = tuple(json.loads(row[1]))
+                self.flips.append((label, pos, e2e_mr.to_string(mr), ref, self.flipped[key], result))
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (key, signature, json.dumps(result)))
+            results.append(result)
+        self.db.commit()
+        return results
+
+    def report(self, out=sys.stdout):
+        print("Incremental: matched %d / %d slots, recomputed %d / %d instances, %d flipped" %
+              (self.slots_matched, self.slots_total, self.recomputed, self.total, len(self.flips)), file=out)
+
+    def write_flips(self, filename):
+        """Write the instances whose results changed into a TSV file."""
+        import pandas as pd
+        flips = pd.DataFrame.from_records(
+            [(label, pos, mr, ref) + tuple(old[:4]) + tuple(new[:4]) + (old[6], new[6])
+             for label, pos, mr, ref, old, new in self.flips],
+            columns=['file', 'position', 'mr', 'ref', 'old_added', 'old_missing', 'old_valerr', 'old_repeated',
+                     'added', 'missing', 'valerr', 'repeated', 'old_fixed_mr', 'fixed_mr'])
+        flips.to_csv(filename, sep=str("\t"), encoding='utf-8', index=False)
+
+
+def score_instances(mrs, refs, fix_type='all', pool=None, cache=None):
+    """Check all instances (gold MRs + refs), return a list of `score_instance` results.
+    If a process pool is given, the instances are split into chunks and checked in parallel by
+    the worker processes (results come back in the original order). If a `ResultCache` is given,
+    only instances not found in the cache are checked."""
+    if cache is not None:
+        keys = [cache.key(mr, ref, fix_type) for mr, ref in zip(mrs, refs)]
+        results = [cache.get(key) for key in keys]
+        # check each distinct missing instance just once (repeated ones count as hits)
+        todo = {}
+        for pos, (key, result) in enumerate(zip(keys, results)):
+            if result is None:
+                todo.setdefault(key, pos)
+        cache.hits += len(keys) - len(todo)
+        cache.misses += len(todo)
+        todo = sorted(todo.values())
+        new_results = score_instances([mrs[pos] for pos in todo], [refs[pos] for pos in todo], fix_type, pool)
+        new_results = {keys[pos]: result for pos, result in zip(todo, new_results)}
+        for key, result in new_results.items():
+            cache.put(key, result)
+        cache.commit()
+        return [result if result is not None else new_results[key] for key, result in zip(keys, results)]
+
+    if pool is None or len(refs) <= 1:
+        return [score_instance(mr, ref, fix_type) for mr, ref in zip(mrs, refs)]
+    return pool.map(_score_instance_args, [(mr, ref, fix_type) for mr, ref in zip(mrs, refs)])
+
+
+class Stats(object):
+    """Running totals of error statistics over a file."""
+
+    # raw counts, from which all the reported statistics are computed
+    COUNTS = ['added', 'missing', 'valerr', 'repeated', 'mr_len',
+              'tot_ok', 'tot_a', 'tot_m', 'tot_ma', 'total_insts', 'identical']
+
+    def __init__(self):
+        self.added, self.missing, self.valerr, self.repeated, self.mr_len = 0, 0, 0, 0, 0
+        self.tot_ok, self.tot_a, self.tot_m, self.tot_ma, self.total_insts = 0, 0, 0, 0, 0
+        self.identical = 0  # fixed MR string identical to the original
+
+    def add(self, raw_mrs, results):
+        """Add `score_instances` results for the given raw MR strings."""
+        for orig_mr, (inst_a, inst_m, inst_v, inst_r, mr_len, _, fixed_mr) in zip(raw_mrs, results):
+            self.added += inst_a
+            self.missing += inst_m
+            self.valerr += inst_v
+            self.repeated += inst_r
+            self.mr_len += mr_len
+            self.total_insts += 1
+            self.identical += orig_mr == fixed_mr
+            # just add the totals
+            if (inst_a and inst_m) or inst_v:
+                self.tot_ma += 1
+            elif inst_a or inst_r:
+                self.tot_a += 1
+            elif inst_m:
+                self.tot_m += 1
+            else:
+                self.tot_ok += 1
+
+    def report(self, filename, out=sys.stdout):
+        """Print the statistics to the `out` file provided (defaults to stdout), return them in a dict
+        (for CSV stat output if multiple files are processed)."""
+        print(filename, file=out)
+        print("A: %5d, M: %5d, V: %5d, R: %5d, L: %5d" %
+              (self.added, self.missing, self.valerr, self.repeated, self.mr_len), file=out)
+        semerr = (self.added + self.missing + self.valerr + self.repeated) / float(self.mr_len)
+        insrate = self.added / float(self.mr_len)
+        delrate = self.missing / float(self.mr_len)
+        wvlrate = self.valerr / float(self.mr_len)
+        print("SemERR = %.4f [InsRate = %.4f, DelRate = %.4f, WVlRate = %.4f]" % (semerr, insrate, delrate, wvlrate), file=out)
+        print("InstOK : %5d / %5d = %.4f" % (self.tot_ok, self.total_insts, self.tot_ok / float(self.total_insts)), file=out)
+        print("InstAdd: %5d / %5d = %.4f" % (self.tot_a, self.total_insts, self.tot_a / float(self.total_insts)), file=out)
+        print("InstMis: %5d / %5d = %.4f" % (self.tot_m, self.total_insts, self.tot_m / float(self.total_insts)), file=out)
+        print("InstM+A: %5d / %5d = %.4f" % (self.tot_ma, self.total_insts, self.tot_ma / float(self.total_insts)), file=out)
+
+        print("Fixed MR String identical to original in %d cases." % self.identical)
+
+        return self.as_dict(filename)
+
+    def as_dict(self, filename):
+        """Return the statistics in a dict."""
+        semerr = (self.added + self.missing + self.valerr + self.repeated) / float(self.mr_len)
+        return {'filename': filename,
+                'semerr': semerr,
+                'added': self.added,
+                'missing': self.missing,
+                'valerr': self.valerr,
+                'repeated': self.repeated,
+                'total_attr': self.mr_len,
+                'total_insts': self.total_insts,
+                'inst_ok': self.tot_ok / float(self.total_insts),
+                'inst_add': self.tot_a / float(self.total_insts),
+                'inst_mis': self.tot_m / float(self.total_insts),
+                'inst_m+a': self.tot_ma / float(self.total_insts),}
+
+    def counts(self):
+        """Return the raw counts in a dict (unlike the ratios, these can be summed over parts of the data)."""
+        return OrderedDict((name, getattr(self, name)) for name in self.COUNTS)
+
+    def merge(self, counts):
+        """Add raw counts (as returned by `counts`) of another part of the data."""
+        for name in self.COUNTS:
+            setattr(self, name, getattr(self, name) + counts[name])
+
+
+class PartialStats(object):
+    """Raw statistics of checked inputs (or shards of a larger input, under a common label), saved to a JSON
+    file so that the results of separate runs can be merged (see `merge_partials`)."""
+
+    VERSION = 1
+
+    def __init__(self):
+        self.parts = []  # (label, fix type, raw counts)
+
+    def add(self, label, fix_type, stats):
+        self.parts.append((label, fix_type, stats.counts()))
+
+    def save(self, filename):
+        with codecs.open(filename, 'w', 'UTF-8') as fh:
+            json.dump({'version': self.VERSION, 'patterns': PATTERNS_HASH,
+                       'parts': [{'label': label, 'fix_type': fix_type, 'counts': counts}
+                                 for label, fix_type, counts in self.parts]}, fh, indent=2)
+
+
+def merge_partials(filenames, out=sys.stderr):
+    """Merge raw statistics from `PartialStats` files: parts with the same label and fix type are summed up.
+    Returns the merged stats as a list of (label, fix type, `Stats`), in the order of first appearance."""
+    merged = OrderedDict()
+    patterns = set()
+    for filename in filenames:
+        with codecs.open(filename, 'r', 'UTF-8') as fh:
+            data = json.load(fh)
+        if data.get('version') != PartialStats.VERSION:
+            raise ValueError('Unsupported partial stats file version in %s' % filename)
+        patterns.add(data['patterns'])
+        for part in data['parts']:
+            key = (part['label'], part['fix_type'])
+            if key not in merged:
+                merged[key] = Stats()
+            merged[key].merge(part['counts'])
+    if len(patterns) > 1:
+        print("Warning: merging statistics computed with different realization patterns", file=out)
+    return [(label, fix_type, stats) for (label, fix_type), stats in merged.items()]
+
+
+def stats_table(results):
+    """Format a list of stats dicts (as returned by `Stats.report`) as a CSV table."""
+    import pandas as pd
+    results = pd.DataFrame.from_records(results)
+    return results.to_csv(columns=['filename', 'total_insts', 'total_attr', 'semerr',
+                                   'added', 'missing', 'valerr', 'repeated', 'inst_ok',
+                                   'inst_add', 'inst_mis', 'inst_m+a'],
+                          index=False)
+
+
+def write_outputs(df, mr_col, ref_col, raw_mrs, refs, results, dump=None, fix=None, append=False):
+    """Dump per-instance stats to a TSV and/or output a fixed CSV for the given (chunk of) input
+    and its `score_instances` results. If `append` is set, add to existing files (without header)."""
+    if not dump and not fix:
+        return
+    import pandas as pd
+    if df is None:
+        df = pd.DataFrame({mr_col: raw_mrs, ref_col: refs})
+    added, missing, valerr, repeated, mr_len, diffs, fixed_mrs = [list(col) for col in zip(*results)] or [[]] * 7
+    mode = 'a' if append else 'w'
     # dump per-instance stats to TSV if needed
     if dump:
         df['added'] = added
@@ -432,52 +1483,643 @@ def process_file(filename, dump=None, fix=None, fix_type='all', out=sys.stdout,
         df['mr_len'] = mr_len
         df['diff'] = diffs
         df['fixed_mr'] = fixed_mrs
-        df.to_csv(dump, sep=str("\t"), encoding='utf-8', index=False,
+        df.to_csv(dump, sep=str("\t"), encoding='utf-8', index=False, mode=mode, header=not append,
                   columns=[mr_col, ref_col, 'added', 'missing', 'valerr', 'repeated', 'mr_len', 'diff', 'fixed_mr'])
     if fix:
         df[mr_col] = fixed_mrs
         df['orig_mr'] = raw_mrs
         df['fixed'] = [1 if fixed_mr != orig_mr else 0 for orig_mr, fixed_mr in zip(raw_mrs, fixed_mrs)]
-        df.to_csv(fix, encoding='utf-8', index=False, columns=[mr_col, ref_col, 'fixed', 'orig_mr'])
-
-    # return the stats for CSV stat output if multiple files are processed
-    return {'filename': filename,
-            'semerr': semerr,
-            'added': sum(added),
-            'missing': sum(missing),
-            'valerr': sum(valerr),
-            'repeated': sum(repeated),
-            'total_attr': sum(mr_len),
-            'total_insts': len(refs),
-            'inst_ok': tot_ok / float(len(refs)),
-            'inst_add': tot_a / float(len(refs)),
-            'inst_mis': tot_m / float(len(refs)),
-            'inst_m+a': tot_ma / float(len(refs)),}
+        df.to_csv(fix, encoding='utf-8', index=False, mode=mode, header=not append,
+                  columns=[mr_col, ref_col, 'fixed', 'orig_mr'])
+
+
+def process_file(filename, dump=None, fix=None, fix_type='all', out=sys.stdout, mrs=None, pool=None,
+                 chunk_size=None, cache=None, incremental=None, dump_columns=None, partial=None, label=None,
+                 errors=None):
+    """Analyze a single file, optionally dump per-instance stats to a TSV and/or a columnar directory
+    (see `write_columns_dump`). Will print to the `out` file provided (defaults to stdout). If `chunk_size`
+    is set, the file is read and checked and the outputs are written in chunks of the given number of
+    instances, so memory use does not grow with file size (except for the columnar dump). Results are looked
+    up in/added to the `cache`, if given, or checked incrementally using an `IncrementalStore`, if given.
+    Stats are reported under `label` (defaults to the file name), and added to `partial` (`PartialStats`),
+    if given. Per-instance errors are added to `errors` (`significance.ErrorVectors`), if given."""
+    stats = Stats()
+    offset = 0
+    all_raw_mrs, all_refs, all_results = [], [], []
+    for chunk_no, (df, mr_col, ref_col, raw_mrs, chunk_mrs, refs) in enumerate(read_input(filename, mrs, chunk_size)):
+        if incremental is not None:
+            results = incremental.score(chunk_mrs, refs, fix_type, filename, offset)
+        else:
+            results = score_instances(chunk_mrs, refs, fix_type, pool, cache)
+        offset += len(refs)
+        stats.add(raw_mrs, results)
+        if errors is not None:
+            errors.add(label or filename, raw_mrs, results)
+        write_outputs(df, mr_col, ref_col, raw_mrs, refs, results, dump, fix, append=(chunk_no > 0))
+        if dump_columns:
+            all_raw_mrs.extend(raw_mrs)
+            all_refs.extend(refs)
+            all_results.extend(results)
+    if dump_columns:
+        write_columns_dump(dump_columns, all_raw_mrs, all_refs, all_results)
+    if partial is not None:
+        partial.add(label or filename, fix_type, stats)
+    return stats.report(label or filename, out)
+
+
+def add_suffix(filename, suffix):
+    """Add a suffix to the file name, before the extension."""
+    if re.search(r'\.[^./]+$', filename):
+        return re.sub(r'(\.[^./]+)$', '.' + suffix + r'\1', filename)
+    return filename + '.' + suffix
+
+
+def process_file_multi(filename, fix_types, dump=None, fix=None, out=sys.stdout, mrs=None, pool=None,
+                       chunk_size=None, dump_columns=None, partial=None, label=None, errors=None, cache=None):
+    """Analyze a single file for multiple fix types at once (see `score_instances_multi`). Outputs
+    are the same as for `process_file`, once per fix type (file names get the fix type as a suffix).
+    Returns a list of stats dicts, one per fix type. `label`, `partial`, `errors` and `cache` work as
+    in `process_file`."""
+    stats = OrderedDict((fix_type, Stats()) for fix_type in fix_types)
+    labels = OrderedDict((fix_type, '%s [%s]' % (label or filename, fix_type)) for fix_type in fix_types)
+    all_raw_mrs, all_refs, all_results = [], [], {fix_type: [] for fix_type in fix_types}
+    for chunk_no, (df, mr_col, ref_col, raw_mrs, chunk_mrs, refs) in enumerate(read_input(filename, mrs, chunk_size)):
+        results = score_instances_multi(chunk_mrs, refs, fix_types, pool, cache)
+        for fix_type in fix_types:
+            stats[fix_type].add(raw_mrs, results[fix_type])
+            if errors is not None:
+                errors.add(labels[fix_type], raw_mrs, results[fix_type])
+            write_outputs(df.copy() if df is not None else None, mr_col, ref_col, raw_mrs, refs, results[fix_type],
+                          add_suffix(dump, fix_type) if dump else None, add_suffix(fix, fix_type) if fix else None,
+                          append=(chunk_no > 0))
+            if dump_columns:
+                all_results[fix_type].extend(results[fix_type])
+        if dump_columns:
+            all_raw_mrs.extend(raw_mrs)
+            all_refs.extend(refs)
+    if dump_columns:
+        for fix_type in fix_types:
+            write_columns_dump(add_suffix(dump_columns, fix_type), all_raw_mrs, all_refs, all_results[fix_type])
+    if partial is not None:
+        for fix_type, fix_stats in stats.items():
+            partial.add(labels[fix_type], fix_type, fix_stats)
+    return [fix_stats.report(labels[fix_type], out) for fix_type, fix_stats in stats.items()]
+
+
+def process_file_sampled(filename, width, errors, fix_type='all', out=sys.stdout, mrs=None, pool=None, cache=None,
+                         batch_size=1000, n_resamples=1000, seed=None, label=None):
+    """Check random batches of instances of a (large) file until the bootstrap confidence interval of SemERR
+    is at most `width` wide (see `significance.sample_until_narrow`). Stats are reported for the checked
+    sample only, its per-instance errors are added to `errors` (`ErrorVectors`)."""
+    from significance import sample_until_narrow
+    _, _, _, raw_mrs, file_mrs, refs = next(read_input(filename, mrs))
+    checked, results = sample_until_narrow(
+        lambda idxs: score_instances([file_mrs[idx] for idx in idxs], [refs[idx] for idx in idxs], fix_type, pool, cache),
+        len(refs), width, batch_size, n_resamples, seed=seed)
+    sample_mrs = [raw_mrs[idx] for idx in checked]
+    errors.add(label or filename, sample_mrs, results)
+    stats = Stats()
+    stats.add(sample_mrs, results)
+    print("Checked a random sample of %d / %d instances" % (len(checked), len(refs)), file=out)
+    return stats.report(label or filename, out)
+
+
+def process_file_threshold(filename, threshold, dump=None, keep=None, out=sys.stdout, mrs=None, chunk_size=None):
+    """Check which instances of a file have more errors than allowed by the given `ErrorThreshold`. Optionally
+    dump a TSV with the MRs, refs and a 0/1 `over_threshold` column and/or write the instances that are not
+    over the threshold into a CSV (with the input columns unchanged). Returns the number of instances over.
+    Raises a ValueError for `keep` with CSV/TSV inputs read from the input cache (it has the MRs and refs only)."""
+    import pandas as pd
+    if keep and not mrs and _INPUT_CACHE is not None:
+        raise ValueError('Cannot keep all input columns of %s, the input cache only has MRs and refs' % filename)
+    over_before = threshold.over
+    for chunk_no, (df, mr_col, ref_col, raw_mrs, chunk_mrs, refs) in enumerate(read_input(filename, mrs, chunk_size)):
+        over = [threshold.exceeds(mr, ref) for mr, ref in zip(chunk_mrs, refs)]
+        if df is None:
+            df = pd.DataFrame({mr_col: raw_mrs, ref_col: refs})
+        mode = 'a' if chunk_no > 0 else 'w'
+        if dump:
+            df['over_threshold'] = [int(inst_over) for inst_over in over]
+            df.to_csv(dump, sep=str("\t"), encoding='utf-8', index=False, mode=mode, header=(chunk_no == 0),
+                      columns=[mr_col, ref_col, 'over_threshold'])
+            del df['over_threshold']
+        if keep:
+            df[[not inst_over for inst_over in over]].to_csv(keep, encoding='utf-8', index=False, mode=mode,
+                                                             header=(chunk_no == 0))
+    print("%s: %d instances over threshold" % (filename, threshold.over - over_before), file=out)
+    return threshold.over - over_before
+
+
+def process_stream(inp=sys.stdin, out=sys.stdout, fix_type='all', cache=None):
+    """Check instances read line by line from `inp`, given either as JSON objects (`{"mr": MR, "ref": text}`)
+    or as TSV lines (MR, tab, ref; a header line is skipped). Writes a JSON record with the results for each
+    instance to `out` as soon as it is checked (or a record with an error message if the line cannot be
+    checked). At EOF, writes a record with the aggregate stats (`{"summary": stats}`). Returns the stats dict."""
+    stats = Stats()
+    for line_no, line in enumerate(iter(inp.readline, ''), start=1):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        try:
+            if line.lstrip().startswith('{'):
+                inst = json.loads(line)
+                raw_mr, ref = inst['mr'], inst['ref']
+            else:
+                raw_mr, ref = line.split('\t', 1)
+                if line_no == 1 and (raw_mr, ref) in [('mr', 'ref'), ('MR', 'output')]:
+                    continue
+            mr = e2e_mr.parse(raw_mr)
+            result = score_instances([mr], [ref], fix_type, cache=cache)[0]
+        except Exception as exc:
+            print(json.dumps({'line': line_no, 'error': '%s: %s' % (exc.__class__.__name__, exc)}), file=out)
+            out.flush()
+            continue
+        inst_a, inst_m, inst_v, inst_r, mr_len, diff, fixed_mr = result
+        stats.add([raw_mr], [result])
+        print(json.dumps({'line': line_no, 'mr': raw_mr, 'ref': ref, 'added': inst_a, 'missing': inst_m,
+                          'valerr': inst_v, 'repeated': inst_r, 'mr_len': mr_len, 'diff': json.loads(diff),
+                          'fixed_mr': fixed_mr}), file=out)
+        out.flush()
+    summary = stats.as_dict('-') if stats.mr_len else {'filename': '-', 'total_insts': stats.total_insts}
+    print(json.dumps({'summary': summary}, sort_keys=True), file=out)
+    out.flush()
+    return summary
+
+
+def process_files(filenames, fix_type='all', out=sys.stdout, mrs=None, pool=None, chunk_size=None, cache=None,
+                  incremental=None, partial=None, errors=None):
+    """Analyze multiple files, return a list of their stats dicts. Unless reading in chunks or checking
+    incrementally, all files are read first and checked at once (so all of them can be processed in parallel).
+    Stats are added to `partial` (`PartialStats`) and per-instance errors to `errors` (`ErrorVectors`), if given."""
+    if chunk_size or incremental is not None:
+        return [process_file(filename, fix_type=fix_type, out=out, mrs=mrs, pool=pool, chunk_size=chunk_size,
+                             cache=cache, incremental=incremental, partial=partial, errors=errors)
+                for filename in filenames]
+    inputs = [next(read_input(filename, mrs)) for filename in filenames]
+    all_results = score_instances([mr for _, _, _, _, file_mrs, _ in inputs for mr in file_mrs],
+                                  [ref for _, _, _, _, _, file_refs in inputs for ref in file_refs],
+                                  fix_type, pool, cache)
+    file_stats, offset = [], 0
+    for filename, (_, _, _, raw_mrs, _, refs) in zip(filenames, inputs):
+        stats = Stats()
+        stats.add(raw_mrs, all_results[offset:offset + len(refs)])
+        if errors is not None:
+            errors.add(filename, raw_mrs, all_results[offset:offset + len(refs)])
+        offset += len(refs)
+        if partial is not None:
+            partial.add(filename, fix_type, stats)
+        file_stats.append(stats.report(filename, out))
+    return file_stats
+
+
+class GoldMRs(object):
+    """Gold-standard MRs from a file (one per line), parsed, converted to dicts and encoded as counts
+    just once, to be shared when checking many system outputs against them. MRs with values unknown
+    to the realization patterns are marked (they cannot be checked)."""
+
+    def __init__(self, filename, encoder):
+        self.filename = filename
+        self.raw = load_lines(filename)
+        self.mrs = [e2e_mr.parse(line) for line in self.raw]
+        self.known = [all(value.lower() in CAPITALIZE.get(slot, {}) for slot, value in mr) for mr in self.mrs]
+        self.dicts = [mr_to_dict(mr) if known else {} for mr, known in zip(self.mrs, self.known)]
+        self.counts = encoder.encode(self.dicts)
+
+    def __len__(self):
+        return len(self.raw)
+
+
+def _classify_args(args):
+    """`reclassify_mr` for a ref and gold-standard MR dict in one tuple, to be used with `Pool.map`."""
+    ref, mr_dict = args
+    return reclassify_mr(ref, mr_dict=mr_dict)[0]
+
+
+def parse_matrix_path(path):
+    """Split a system output path in an experiment matrix (`condition/system.runN.txt`) into condition,
+    system and run number (None if not given)."""
+    condition = os.path.basename(os.path.dirname(path))
+    match = re.match(r'^(.*?)(?:\.run(\d+))?\.txt$', os.path.basename(path))
+    return condition, match.group(1), int(match.group(2)) if match.group(2) is not None else None
+
+
+def evaluate_matrix(directory, mr_files, fix_type='all', out=sys.stderr, pool=None):
+    """Check all system outputs in an experiment matrix directory (`condition/system.runN.txt`) against
+    the gold-standard MRs, which are parsed and encoded only once per MR file. MR files are given as
+    a list of (glob pattern or None, file name); the first one whose pattern matches the output path
+    (relative to `directory`) is used. Outputs with no MR file or a different number of lines are skipped.
+    Returns a list of stats dicts (one per file, with condition, system and run added)."""
+    import fnmatch
+    import glob
+    encoder = CountEncoder()
+    golds = {}
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, '*', '*.txt'))):
+        rel_path = os.path.relpath(path, directory)
+        mr_file = next((mr_file for pattern, mr_file in mr_files
+                        if pattern is None or fnmatch.fnmatch(rel_path, pattern)), None)
+        if mr_file is None:
+            print("%s: no MRs given, skipping" % rel_path, file=out)
+            continue
+        if mr_file not in golds:
+            golds[mr_file] = GoldMRs(mr_file, encoder)
+        gold = golds[mr_file]
+        refs = load_lines(path)
+        if len(refs) != len(gold):
+            print("%s: %d lines but %d MRs in %s, skipping" % (rel_path, len(refs), len(gold), mr_file), file=out)
+            continue
+        rows = [row for row, known in enumerate(gold.known) if known]
+        if len(rows) < len(gold):
+            print("%s: %d MRs with unknown values left out" % (rel_path, len(gold) - len(rows)), file=out)
+
+        args = [(refs[row], gold.dicts[row]) for row in rows]
+        out_mrs = pool.map(_classify_args, args) if pool is not None else [_classify_args(arg) for arg in args]
+        added, missing, valerr, repeated, _, _ = check_outputs(encoder, gold.counts[rows], encoder.encode(out_mrs),
+                                                               [fix_type])[fix_type]
+        stats = Stats()
+        stats.add([gold.raw[row] for row in rows],
+                  [(inst_a, inst_m, inst_v, inst_r, len(gold.mrs[row]), None, None)
+                   for row, inst_a, inst_m, inst_v, inst_r in zip(rows, added.tolist(), missing.tolist(),
+                                                                  valerr.tolist(), repeated.tolist())])
+        record = stats.as_dict(rel_path)
+        record['condition'], record['system'], record['run'] = parse_matrix_path(rel_path)
+        print("%s: SemERR = %.4f" % (rel_path, record['semerr']), file=out)
+        records.append(record)
+    return records
+
+
+def aggregate_runs(records):
+    """Aggregate per-file stats dicts over runs, return a data frame with mean and standard deviation
+    of each statistic for each condition and system."""
+    import pandas as pd
+    stats = ['semerr', 'added', 'missing', 'valerr', 'repeated', 'inst_ok', 'inst_add', 'inst_mis', 'inst_m+a']
+    results = pd.DataFrame.from_records(records, columns=['condition', 'system', 'run'] + stats)
+    groups = results.groupby(['condition', 'system'], sort=True)
+    table = groups[stats].agg(['mean', 'std'])
+    table.columns = ['%s_%s' % (stat, agg) for stat, agg in table.columns]
+    table.insert(0, 'runs', groups.size())
+    return table.reset_index()
+
+
+class PatternProfiler(object):
+    """Profiles the realization patterns: each slot value's pattern (or each value for verbatim slots
+    such as name) is compiled and run separately over the texts, recording the total time, number
+    of calls and matches, and the slowest input for each. Texts on which the combined matcher used
+    for checking takes at least `slow_threshold` milliseconds are recorded as slow."""
+
+    def __init__(self, realizations, slow_threshold=None):
+        self.keys = []
+        self.regexes = []
+        for slot in realizations.keys():
+            if not isinstance(realizations[slot], dict):
+                for value in realizations[slot]:
+                    self.keys.append((slot, value))
+                    self.regexes.append(compile_patterns([value]))
+            else:
+                for value in realizations[slot].keys():
+                    self.keys.append((slot, value))
+                    self.regexes.append(compile_patterns(realizations[slot][value]))
+        self.times = [0.0] * len(self.keys)
+        self.calls = [0] * len(self.keys)
+        self.matches = [0] * len(self.keys)
+        self.worst = [(0.0, None)] * len(self.keys)  # (time, text)
+        self.slow_threshold = slow_threshold
+        self.slow = []  # (time, slowest pattern index, text)
+        self.texts = 0
+        self.matcher_time = 0.0
+
+    def profile(self, text):
+        """Profile all patterns on the given text."""
+        matcher = get_matcher()
+        matcher.find_all(text)  # compile the regexes needed, so only matching is timed
+        start_time = timer()
+        matcher.find_all(text)
+        matcher_time = timer() - start_time
+        self.texts += 1
+        self.matcher_time += matcher_time
+
+        slowest, slowest_time = None, -1.0
+        for idx, regex in enumerate(self.regexes):
+            start_time = timer()
+            matches = sum(1 for _ in regex.finditer(text))
+            elapsed = timer() - start_time
+            self.times[idx] += elapsed
+            self.calls[idx] += 1
+            self.matches[idx] += matches
+            if elapsed > self.worst[idx][0]:
+                self.worst[idx] = (elapsed, text)
+            if elapsed > slowest_time:
+                slowest, slowest_time = idx, elapsed
+
+        if self.slow_threshold is not None and matcher_time * 1000 >= self.slow_threshold:
+            self.slow.append((matcher_time, slowest, text))
+
+    def report(self, top=20, out=sys.stdout):
+        """Print the `top` most expensive patterns and all slow texts."""
+        print("Profiled %d texts, combined matcher time: %.3f s, sum of separate patterns: %.3f s" %
+              (self.texts, self.matcher_time, sum(self.times)), file=out)
+        order = sorted(range(len(self.keys)), key=lambda idx: -self.times[idx])
+        print("%-16s %-28s %10s %8s %8s %10s %10s" %
+              ('slot', 'value', 'total_ms', 'calls', 'matches', 'avg_us', 'worst_ms'), file=out)
+        for idx in order[:top]:
+            slot, value = self.keys[idx]
+            print("%-16s %-28s %10.2f %8d %8d %10.2f %10.3f" %
+                  (slot, value, self.times[idx] * 1000, self.calls[idx], self.matches[idx],
+                   self.times[idx] * 1e6 / max(self.calls[idx], 1), self.worst[idx][0] * 1000), file=out)
+            if self.worst[idx][1] is not None:
+                print("    worst input: %s" % self.worst[idx][1], file=out)
+        if self.slow_threshold is not None:
+            print("Slow texts (matcher time >= %.2f ms): %d" % (self.slow_threshold, len(self.slow)), file=out)
+            for matcher_time, idx, text in sorted(self.slow, key=lambda item: -item[0]):
+                print("%8.3f ms [%s=%s]: %s" % ((matcher_time * 1000,) + self.keys[idx] + (text,)), file=out)
+
+
+class ScoringServer(object):
+    """Resident scoring service (e.g. for reranking beam search candidates), so that the startup
+    costs are paid just once. Reads JSON requests, one per line, and writes one JSON response line
+    for each:
+
+    - `{"mr": MR, "candidates": [text, ...]}` returns `{"results": [{"added": A, "missing": M,
+      "valerr": V, "repeated": R}, ...]}` (one result per candidate); a list of such requests
+      returns a list of responses
+    - `{"cmd": "stats"}` returns the numbers of requests and candidates processed so far and latency
+      percentiles (in milliseconds) over recent requests
+
+    MRs are given as strings in the E2E format (`slot[value], ...`).
+    """
+
+    def __init__(self, max_latencies=10000):
+        self.requests = 0
+        self.candidates = 0
+        self.latencies = deque(maxlen=max_latencies)
+
+    def score(self, mr, candidates):
+        """Score a list of candidate texts against the given MR string."""
+        counts, _ = score_nbest(mr, candidates)
+        results = [{'added': added, 'missing': missing, 'valerr': valerr, 'repeated': repeated}
+                   for added, missing, valerr, repeated in counts]
+        self.candidates += len(candidates)
+        return {'results': results}
+
+    def stats(self):
+        """Return the numbers of requests & candidates processed and latency percentiles."""
+        latencies = sorted(self.latencies)
+        percentiles = {}
+        if latencies:
+            for perc in [50, 90, 99]:
+                percentiles['p%d' % perc] = latencies[min(len(latencies) - 1, len(latencies) * perc // 100)]
+            percentiles['max'] = latencies[-1]
+        return {'requests': self.requests, 'candidates': self.candidates, 'latency_ms': percentiles}
+
+    def handle(self, request):
+        """Handle a single (decoded) request, return the response."""
+        if isinstance(request, list):
+            return [self.handle(req) for req in request]
+        if not isinstance(request, dict):
+            return {'error': 'Request must be an object or a list of objects'}
+        if request.get('cmd') == 'stats':
+            return self.stats()
+        if 'mr' not in request or 'candidates' not in request:
+            return {'error': 'Request must contain "mr" and "candidates"'}
+        # type('') is the text type in both Python 2 and 3 (with unicode_literals), as decoded by json
+        if not isinstance(request['mr'], type('')):
+            return {'error': '"mr" must be a string'}
+        if (not isinstance(request['candidates'], list) or
+                not all(isinstance(cand, type('')) for cand in request['candidates'])):
+            return {'error': '"candidates" must be a list of strings'}
+        return self.score(request['mr'], request['candidates'])
+
+    def serve(self, inp=sys.stdin, out=sys.stdout):
+        """Process requests from `inp` until EOF, write responses to `out`."""
+        for line in iter(inp.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            start_time = timer()
+            try:
+                request = json.loads(line)
+                is_stats = isinstance(request, dict) and request.get('cmd') == 'stats'
+                response = self.handle(request)
+            except Exception as exc:
+                is_stats = False
+                response = {'error': '%s: %s' % (exc.__class__.__name__, exc)}
+            print(json.dumps(response), file=out)
+            out.flush()
+            if not is_stats:
+                self.requests += 1
+                self.latencies.append((timer() - start_time) * 1000)
 
 
 if __name__ == '__main__':
+    from argparse import ArgumentParser
     ap = ArgumentParser(description='Compute semantic error/fix annotation for E2E dataset')
     ap.add_argument('--dump', '-d', type=str, help='Dump detailed output into a TSV file (one input only)')
     ap.add_argument('--mrs', '-m', type=str, help='Input MRs in a separate, TGen-formatted file (treat input files as TXT with one-per-line inputs)')
     ap.add_argument('--fix', '-f', type=str, help='Output a fixed CSV file (one input only)')
-    ap.add_argument('--fix-type', '--type', '-t',
-                    choices=['all', 'missing', 'added'], default='all', help='Types of errors to fix')
-    ap.add_argument('input_files', nargs='+', type=str, help='Input TSV file(s)')
+    ap.add_argument('--fix-type', '--type', '-t', action='append', choices=['all', 'missing', 'added'],
+                    help='Types of errors to fix (repeat to check for multiple types at once, ' +
+                    'output file names will be suffixed with the type)')
+    ap.add_argument('--jobs', '-j', type=int, default=1, help='Number of parallel worker processes')
+    ap.add_argument('--chunk-size', '-c', type=int,
+                    help='Read, check and write outputs in chunks of the given number of instances (constant memory)')
+    ap.add_argument('--cache', '-C', action='store_true', help='Cache results for repeated instances')
+    ap.add_argument('--cache-size', type=int, default=100000, help='Number of results cached in memory')
+    ap.add_argument('--cache-file', type=str, help='Persistent SQLite cache file (implies --cache)')
+    ap.add_argument('--serve', action='store_true',
+                    help='Run as a scoring server: read JSON requests from stdin, write responses to stdout')
+    ap.add_argument('--profile', action='store_true',
+                    help='Profile the realization patterns on the input texts instead of checking them')
+    ap.add_argument('--profile-threshold', type=float, default=1.0,
+                    help='Report texts taking at least this many milliseconds to match (with --profile)')
+    ap.add_argument('--profile-top', type=int, default=20,
+                    help='Number of most expensive patterns to report (with --profile)')
+    ap.add_argument('--dump-columns', '-D', type=str,
+                    help='Dump detailed output into a directory of NumPy .npy files, with MR diffs as ' +
+                    'count matrices (one input only, see `load_columns`)')
+    ap.add_argument('--input-cache', type=str,
+                    help='Directory to cache parsed CSV/TSV inputs and MR files in (memory-mapped when reloading)')
+    ap.add_argument('--incremental', '-I', type=str,
+                    help='SQLite file with stored matches and results; only re-check what changed with the patterns')
+    ap.add_argument('--flips', type=str,
+                    help='Write instances whose results changed since the last incremental run into a TSV file')
+    ap.add_argument('--matrix', type=str,
+                    help='Check all system outputs in an experiment matrix directory (condition/system.runN.txt) ' +
+                    'and print mean/std over runs for each condition and system')
+    ap.add_argument('--matrix-mrs', type=str, action='append', default=[],
+                    help='MRs for outputs in the matrix: [GLOB=]FILE, where GLOB matches paths relative to ' +
+                    'the matrix directory (repeat for more, first match is used; --mrs applies to all outputs)')
+    ap.add_argument('--max-errors', type=int,
+                    help='Only check if instances have more than the given number of errors, stopping early ' +
+                    '(--dump has a 0/1 over_threshold column instead of the error details)')
+    ap.add_argument('--keep', type=str,
+                    help='Write instances with at most --max-errors errors into a CSV file (one input only)')
+    ap.add_argument('--partial', type=str,
+                    help='Save raw stats of the inputs into a JSON file, to be merged with other runs using --merge')
+    ap.add_argument('--label', type=str,
+                    help='Report the stats of the input under this name, e.g. the name of the whole corpus ' +
+                    'for a shard (one input only)')
+    ap.add_argument('--merge', action='store_true',
+                    help='Merge --partial stats files given as inputs (summing up stats with the same label), ' +
+                    'report as if checked in a single run')
+    ap.add_argument('--bootstrap', type=int,
+                    help='Compute 95%% bootstrap confidence intervals with the given number of resamples, and paired ' +
+                    'bootstrap and approximate randomization tests between inputs with the same MRs')
+    ap.add_argument('--seed', type=int, help='Random seed for --bootstrap and --ci-width')
+    ap.add_argument('--ci-width', type=float,
+                    help='Only check random batches of --chunk-size instances (default: 1000) of each input until ' +
+                    'the SemERR confidence interval is at most this wide (requires --bootstrap)')
+    ap.add_argument('input_files', nargs='*', type=str,
+                    help='Input TSV file(s); "-" reads JSON lines ({"mr": ..., "ref": ...}) or MR<tab>ref TSV lines ' +
+                    'from stdin and writes JSON results for each line to stdout')
     args = ap.parse_args()
 
-    mrs = [DA.parse(line) for line in load_lines(args.mrs)] if args.mrs else None
+    if args.serve:
+        ScoringServer().serve()
+        sys.exit()
+    if args.matrix:
+        mr_files = [tuple(spec.split('=', 1)) if '=' in spec else (None, spec) for spec in args.matrix_mrs]
+        if args.mrs:
+            mr_files.append((None, args.mrs))
+        if not mr_files:
+            ap.error('No MRs given for the matrix (use --matrix-mrs or --mrs)')
+        pool = None
+        if args.jobs > 1:
+            from multiprocessing import Pool
+            pool = Pool(args.jobs)
+        records = evaluate_matrix(args.matrix, mr_files, (args.fix_type or ['all'])[0], pool=pool)
+        print(aggregate_runs(records).to_csv(index=False))
+        if pool is not None:
+            pool.close()
+            pool.join()
+        sys.exit()
+    if not args.input_files:
+        ap.error('No input files given')
+    if args.label and len(args.input_files) > 1:
+        ap.error('--label works with one input only')
+    if args.merge:
+        merged = merge_partials(args.input_files)
+        results = [stats.report(label, sys.stdout if len(merged) == 1 else sys.stderr) for label, _, stats in merged]
+        if args.partial:
+            partial = PartialStats()
+            for label, fix_type, stats in merged:
+                partial.add(label, fix_type, stats)
+            partial.save(args.partial)
+        if len(merged) > 1:
+            print(stats_table(results))
+        sys.exit()
+    if '-' in args.input_files:
+        if len(args.input_files) > 1 or args.mrs or args.dump or args.fix or args.dump_columns or args.partial:
+            ap.error('Standard input (-) must be the only input, with no --mrs/--dump/--fix/--dump-columns/--partial')
+        if args.fix_type and len(args.fix_type) > 1:
+            ap.error('Standard input (-) can only be checked for a single fix type')
+        cache = ResultCache(args.cache_size, args.cache_file) if args.cache or args.cache_file else None
+        process_stream(fix_type=(args.fix_type or ['all'])[0], cache=cache)
+        sys.exit()
 
-    if len(args.input_files) == 1:
-        process_file(args.input_files[0], args.dump, args.fix, args.fix_type, mrs=mrs)
-    else:
+    if args.input_cache:
+        set_input_cache(args.input_cache)
+    mrs = None
+    if args.mrs:
+        mrs = load_mrs(args.mrs)
+
+    if args.profile:
+        profiler = PatternProfiler(REALIZATIONS, args.profile_threshold)
+        for filename in args.input_files:
+            for _, _, _, _, _, refs in read_input(filename, mrs, args.chunk_size):
+                for ref in refs:
+                    profiler.profile(ref)
+        profiler.report(args.profile_top)
+        sys.exit()
+
+    if args.max_errors is not None:
+        if args.partial:
+            ap.error('--partial does not work with --max-errors')
+        if args.fix_type and len(args.fix_type) > 1:
+            ap.error('--max-errors works with a single fix type only')
+        if len(args.input_files) > 1 and (args.dump or args.keep):
+            ap.error('--dump and --keep work with one input only')
+        if args.keep and args.input_cache and not args.mrs:
+            ap.error('--keep does not work with --input-cache (the cache has the MRs and refs only)')
+        threshold = ErrorThreshold(args.max_errors, (args.fix_type or ['all'])[0])
+        for filename in args.input_files:
+            process_file_threshold(filename, threshold, args.dump, args.keep, mrs=mrs, chunk_size=args.chunk_size)
+        threshold.report()
+        sys.exit()
+    elif args.keep:
+        ap.error('--keep requires --max-errors')
+
+    pool = None
+    if args.jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(args.jobs)
+    cache = ResultCache(args.cache_size, args.cache_file) if args.cache or args.cache_file else None
+
+    fix_types = args.fix_type or ['all']
+    partial = PartialStats() if args.partial else None
+    errors = None
+    if args.bootstrap:
+        from significance import ErrorVectors
+        errors = ErrorVectors()
+    elif args.ci_width:
+        ap.error('--ci-width requires --bootstrap')
+    if args.ci_width and (len(fix_types) > 1 or args.incremental or args.partial or args.dump or args.fix or
+                          args.dump_columns):
+        ap.error('--ci-width works with a single fix type and no --incremental/--partial/--dump/--fix/--dump-columns')
+    incremental = None
+    if args.incremental:
+        if len(fix_types) > 1:
+            ap.error('Incremental checking works with a single fix type only')
+        incremental = IncrementalStore(args.incremental)
+    elif args.flips:
+        ap.error('--flips requires --incremental')
+
+    if args.ci_width:
+        results = [process_file_sampled(filename, args.ci_width, errors, fix_types[0],
+                                        out=(sys.stdout if len(args.input_files) == 1 else sys.stderr),
+                                        mrs=mrs, pool=pool, cache=cache, batch_size=args.chunk_size or 1000,
+                                        n_resamples=args.bootstrap, seed=args.seed, label=args.label)
+                   for filename in args.input_files]
+    elif len(fix_types) > 1:
         results = []
         for filename in args.input_files:
-            results.append(process_file(filename, out=sys.stderr, mrs=mrs))
-        results = pd.DataFrame.from_records(results)
-        csv_out = results.to_csv(columns=['filename', 'total_insts', 'total_attr', 'semerr',
-                                          'added', 'missing', 'valerr', 'repeated', 'inst_ok',
-                                          'inst_add', 'inst_mis', 'inst_m+a'],
-                                 index=False)
-        print(csv_out)
+            results.extend(process_file_multi(filename, fix_types, args.dump, args.fix,
+                                              out=(sys.stdout if len(args.input_files) == 1 else sys.stderr),
+                                              mrs=mrs, pool=pool, chunk_size=args.chunk_size,
+                                              dump_columns=args.dump_columns, partial=partial, label=args.label,
+                                              errors=errors, cache=cache))
+        if cache is not None:
+            cache.report(sys.stdout if len(args.input_files) == 1 else sys.stderr)
+    elif len(args.input_files) == 1:
+        process_file(args.input_files[0], args.dump, args.fix, fix_types[0], mrs=mrs, pool=pool,
+                     chunk_size=args.chunk_size, cache=cache, incremental=incremental,
+                     dump_columns=args.dump_columns, partial=partial, label=args.label, errors=errors)
+        if cache is not None:
+            cache.report()
+        if incremental is not None:
+            incremental.report()
+    else:
+        results = process_files(args.input_files, out=sys.stderr, mrs=mrs, pool=pool, chunk_size=args.chunk_size,
+                                cache=cache, incremental=incremental, partial=partial, errors=errors)
+        if cache is not None:
+            cache.report(sys.stderr)
+        if incremental is not None:
+            incremental.report(sys.stderr)
+    if args.flips:
+        incremental.write_flips(args.flips)
+    if partial is not None:
+        partial.save(args.partial)
+
+    if len(args.input_files) > 1:
+        print(stats_table(results))
+    if errors is not None:
+        from significance import ci_table, pairwise_table
+        print(ci_table(errors, args.bootstrap, seed=args.seed).to_csv(index=False))
+        pairs = pairwise_table(errors, args.bootstrap, seed=args.seed)
+        if len(pairs):
+            print(pairs.to_csv(index=False))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -"- encoding: utf-8 -"-
+# the script is Python2/3 compatible
+
+"""Regression test: `slot_error.filter_matches` gives the same results as the original pairwise
+(quadratic) filter from `reclassify_mr`."""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+from slot_error import Match, filter_matches
+
+
+def filter_matches_pairwise(matches, mr_dict):
+    """The original filter, kept as a reference: a match is skipped if it is a substring of another match,
+    or if another match has the same span and a gold value or has been kept already."""
+    filt_matches = []
+    for match in matches:
+        skip = False
+        for other_match in matches:
+            if match is other_match:
+                continue
+            if (match.is_substring(other_match) or
+                (match.is_same_string(other_match) and
+                 (other_match.value in mr_dict.get(other_match.slot, {}).keys() or other_match in filt_matches))):
+                skip = True
+                break
+        if not skip:
+            filt_matches.append(match)
+    return filt_matches
+
+
+SLOT_VALUES = {'food': ['Italian', 'French', 'English'],
+               'area': ['riverside', 'city centre'],
+               'rating': ['low', 'high', 'average'],
+               'near': ['Burger King', 'Café Rouge']}
+
+
+def random_matches(rng):
+    """Generate a random match list, as `Matcher.find_all` would return it (ordered by slot and value,
+    no two matches with the same slot, value and span). Spans are drawn from a few positions, so there
+    are many same-span ties and nested spans."""
+    slot_values = [(slot, value) for slot in sorted(SLOT_VALUES) for value in SLOT_VALUES[slot]]
+    spans = set()
+    n_spans = rng.randint(1, 6)
+    while len(spans) < n_spans:
+        start = rng.randint(0, 8)
+        spans.add((start, start + rng.randint(1, 6)))
+    spans = sorted(spans)
+    matches = []
+    for slot, value in slot_values:
+        for start, end in spans:
+            if rng.random() < 0.25:
+                matches.append(Match(slot, value, start, end))
+    return matches
+
+
+def random_mr_dict(rng, matches):
+    """Gold MR dict with a random subset of the matched values (plus some other values)."""
+    mr_dict = {}
+    for match in matches:
+        if rng.random() < 0.3:
+            mr_dict.setdefault(match.slot, {})[match.value] = 1
+    for slot in SLOT_VALUES:
+        if rng.random() < 0.2:
+            mr_dict.setdefault(slot, {})[rng.choice(SLOT_VALUES[slot])] = 1
+    return mr_dict
+
+
+class FilterMatchesTest(unittest.TestCase):
+
+    def check(self, matches, mr_dict):
+        expected = filter_matches_pairwise(matches, mr_dict)
+        self.assertEqual([str(match) for match in filter_matches(matches, mr_dict)],
+                         [str(match) for match in expected])
+
+    def test_same_span_gold_values(self):
+        # 0, 1 and 2 gold values among matches with the same span
+        matches = [Match('food', 'Italian', 0, 7), Match('food', 'French', 0, 7), Match('area', 'riverside', 0, 7)]
+        for mr_dict in [{}, {'food': {'French': 1}}, {'food': {'Italian': 1, 'French': 1}},
+                        {'food': {'Italian': 1}, 'area': {'riverside': 1}}]:
+            self.check(matches, mr_dict)
+
+    def test_nested(self):
+        # nested containment, incl. spans sharing the start or the end with a longer one
+        matches = [Match('near', 'Café Rouge', 10, 20), Match('food', 'French', 10, 14),
+                   Match('rating', 'low', 16, 20), Match('area', 'riverside', 12, 18),
+                   Match('near', 'Burger King', 0, 25), Match('rating', 'high', 30, 34)]
+        self.check(matches, {})
+        self.check(matches, {'near': {'Café Rouge': 1}})
+
+    def test_random(self):
+        rng = random.Random(1234)
+        for _ in range(5000):
+            matches = random_matches(rng)
+            self.check(matches, random_mr_dict(rng, matches))
+
+
+if __name__ == '__main__':
+    unittest.main()
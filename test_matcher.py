@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -"- encoding: utf-8 -"-
+# the script is Python2/3 compatible
+
+"""Regression test: `slot_error.Matcher.find_all` (all patterns in a single pass, bucketed by the first
+character) finds the same matches as running each slot value's compiled patterns with `finditer`, as the
+original per-value matching loop did."""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import codecs
+import glob
+import os
+import random
+import unittest
+
+import pandas as pd
+
+from slot_error import CAPITALIZE, REALIZATIONS, compile_patterns, get_matcher
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def per_value_patterns():
+    """Compile each slot value's patterns separately: a list of (slot, value or None for verbatim slots, regex)."""
+    patterns = []
+    for slot in REALIZATIONS.keys():
+        if not isinstance(REALIZATIONS[slot], dict):
+            patterns.append((slot, None, compile_patterns(REALIZATIONS[slot])))
+        else:
+            for value in REALIZATIONS[slot].keys():
+                patterns.append((slot, CAPITALIZE[slot][value.lower()], compile_patterns(REALIZATIONS[slot][value])))
+    return patterns
+
+
+def find_all_per_value(patterns, text):
+    """The original matching, kept as a reference: `finditer` for each slot value's patterns in turn."""
+    return [(slot, value if value is not None else CAPITALIZE[slot][match.group(0).lower()], match.start(), match.end())
+            for slot, value, regex in patterns for match in regex.finditer(text)]
+
+
+def shipped_texts():
+    """All distinct refs and system outputs in this repository."""
+    texts = set()
+    for filename in (glob.glob(os.path.join(BASE_DIR, 'cleaned-data', '*.csv')) +
+                     glob.glob(os.path.join(BASE_DIR, 'partially-cleaned-data', '*', '*.csv'))):
+        texts.update(pd.read_csv(filename, encoding='UTF-8')['ref'])
+    for filename in glob.glob(os.path.join(BASE_DIR, 'system-outputs', '*', '*.txt')):
+        with codecs.open(filename, 'r', 'UTF-8') as fh:
+            texts.update(line.strip() for line in fh)
+    return sorted(texts)
+
+
+# words from the patterns' surroundings, punctuation and non-ASCII characters (incl. ones that match ASCII
+# letters case-insensitively)
+EXTRA_WORDS = ['out', 'of', 'five', '5', '3', '1', 'stars', 'star', '-', '--', ',', '.', "'s", '£', '£20', '£20-25',
+               'rated', 'rating', 'reviews', 'very', 'not', "isn't", 'well', 'kids', 'children', 'family', 'friendly',
+               'İndian', 'ıtalian', 'café', 'CAFÉ', 'Straße', 'é', 'K', 'ſ', '日本', '  ']
+
+
+def random_texts(rng, texts, n_texts):
+    """Generate random texts from words of the given texts, slot values and `EXTRA_WORDS`, in random case."""
+    words = sorted(set(word for text in texts[:2000] for word in text.split()))
+    words += [value for slot in sorted(CAPITALIZE) for value in sorted(CAPITALIZE[slot].values())]
+    words += EXTRA_WORDS
+    result = []
+    for _ in range(n_texts):
+        text = []
+        for _ in range(rng.randint(1, 25)):
+            word = rng.choice(words)
+            case = rng.random()
+            if case < 0.1:
+                word = word.upper()
+            elif case < 0.2:
+                word = word.lower()
+            text.append(word)
+        result.append(rng.choice([' ', ' ', '-', '']).join(text))
+    return result
+
+
+class MatcherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.patterns = per_value_patterns()
+        cls.texts = shipped_texts()
+
+    def check(self, texts):
+        matcher = get_matcher()
+        for text in texts:
+            self.assertEqual([(match.slot, match.value, match._start, match._end) for match in matcher.find_all(text)],
+                             find_all_per_value(self.patterns, text), text)
+
+    def test_shipped(self):
+        self.check(self.texts)
+
+    def test_random(self):
+        self.check(random_texts(random.Random(1234), self.texts, 5000))
+
+    def test_slots(self):
+        # matching only some slots gives the matches of those slots
+        matcher = get_matcher()
+        rng = random.Random(1234)
+        slots = list(REALIZATIONS.keys())
+        for text in self.texts[:3000]:
+            subset = tuple(slot for slot in slots if rng.random() < 0.5)
+            self.assertEqual([(match.slot, match.value, match._start, match._end)
+                              for match in matcher.find_all(text, subset)],
+                             [match for match in find_all_per_value(self.patterns, text) if match[0] in subset], text)
+
+
+if __name__ == '__main__':
+    unittest.main()